@@ -0,0 +1,141 @@
+"""
+asyncio building blocks for running the AKI detection system on a single
+event loop (model.py --asyncio).
+
+Reading from the hospital, paging and snapshotting are multiplexed on one
+thread: messages are acknowledged as soon as the database is updated,
+positive results are paged by concurrent tasks with an asyncio HTTP
+client, and the work that would block the loop (model scoring, writing
+snapshots to disk) is handed to executor threads.
+
+"""
+
+import asyncio
+from concurrent.futures import Executor
+from time import perf_counter
+import simulator
+from connection import ConnectionManager
+
+MLLP_END = bytes([simulator.MLLP_END_OF_BLOCK, simulator.MLLP_CARRIAGE_RETURN])
+
+
+async def read_mllp_message(reader: asyncio.StreamReader) -> bytes:
+    """
+    Reads the next MLLP framed message from the stream.
+
+    Args:
+        reader {asyncio.StreamReader} - stream connected to the hospital
+
+    Returns:
+        {bytes} - framed message, b"" if the connection was closed between messages
+    """
+    try:
+        return await reader.readuntil(MLLP_END)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("connection closed in the middle of a message") from e
+        return b""
+
+
+class AsyncPager:
+    """
+    HTTP/1.0 client for the pager built on asyncio streams, so any number
+    of pages can be in flight without holding up ingestion.
+
+    Args:
+        address {str} - host:port of the pager
+        give_up_after {float} - seconds after which a page that still hasn't gone through is dropped
+        timeout {float} - seconds to wait for the pager to respond
+    """
+
+    def __init__(self, address: str, give_up_after: float, timeout: float) -> None:
+        self.connection = ConnectionManager("pager", address, give_up_after=give_up_after)
+        self.timeout = timeout
+
+    async def page(self, mrn: str) -> int:
+        """
+        Pages the clinical response team about a patient, retrying with
+        backoff while the pager is unreachable.
+
+        Args:
+            mrn {str} - medical record number to send
+
+        Returns:
+            {int} - HTTP status of the response, None if giving up
+        """
+        request = f"POST /page HTTP/1.0\r\n"
+        request += f"Content-type: text/plain\r\n"
+        request += f"Content-Length: {len(mrn)}\r\n"
+        request += "\r\n"
+        request += f"{mrn}"
+
+        started = perf_counter() # failed connects and failed requests both count towards giving up
+        while True:
+            streams = await self.connection.connect_async(started) # new connection for every request with HTTP/1.0
+            if streams is None:
+                return None
+            reader, writer = streams
+            try:
+                writer.write(request.encode())
+                status_line = await asyncio.wait_for(reader.readline(), self.timeout)
+                if len(status_line) == 0:
+                    raise ConnectionError("pager closed connection without a response")
+                return int(status_line.split(b" ")[1])
+            except (OSError, asyncio.TimeoutError) as e: # retry with backoff
+                print(f"Error sending to pager! {e}")
+                delay = self.connection.attempt_failed(started, e)
+                if delay is None:
+                    return None
+            finally:
+                writer.close()
+            await asyncio.sleep(delay)
+
+
+class SnapshotWriter:
+    """
+    Writes snapshots of the database in an executor thread.
+
+    Call mark_dirty after every change. At most one snapshot is written at
+    a time, changes made while it is being written (or within min_interval
+    of the start of the previous one) are included in the next one, so a
+    burst of messages costs one or two writes instead of one per message.
+
+    Args:
+        pack {callable} - returns the arrays of a snapshot, called on the event loop
+            (see snapshot.pack_snapshot) so the database is never read by two threads
+        write {callable} - writes the packed arrays, called in the executor
+        executor {Executor} - executor the snapshots are written in
+        min_interval {float} - minimum seconds between the start of two snapshots
+    """
+
+    def __init__(self, pack, write, executor: Executor, min_interval: float = 0.0) -> None:
+        self.pack = pack
+        self.write = write
+        self.executor = executor
+        self.min_interval = min_interval
+        self._dirty = False
+        self._task = None
+
+    def mark_dirty(self) -> None:
+        self._dirty = True
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while self._dirty:
+            self._dirty = False
+            started = loop.time()
+            arrays = self.pack()
+            try:
+                await loop.run_in_executor(self.executor, self.write, arrays)
+            except OSError as e: # keep running, the next change retries
+                print(f"Error writing snapshot! {e}")
+            await asyncio.sleep(self.min_interval - (loop.time() - started))
+
+    async def flush(self) -> None:
+        """
+        Waits until every change marked so far has been written.
+        """
+        if self._task is not None:
+            await asyncio.shield(self._task) # a cancelled caller must not cancel the write
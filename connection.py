@@ -0,0 +1,203 @@
+"""
+Connection management for the hospital MLLP server and the pager.
+
+Reconnects use exponential backoff with full jitter that is reset after
+every successful connection, so a restarted server is picked up within a
+fraction of a second and a long outage never turns into a fixed number of
+attempts that eventually stops the system from reading.
+
+"""
+
+import asyncio
+import random
+import socket
+import time
+from time import perf_counter
+from prometheus_client import Counter, Gauge, Histogram
+
+Connection_healthy = Gauge("Connection_healthy", 'Whether a connection is currently established', ["connection"])
+# 1 while connected, 0 while (re)connecting
+Connection_failures_counter = Counter("Connection_failures_counter", 'Number of failed connection attempts and broken connections', ["connection"])
+# Failed connects plus connections that broke with an error
+Reconnect_latency = Histogram("Reconnect_latency", 'Time from losing a connection to re-establishing it', ["connection"],
+                              buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60])
+# How long we were unable to receive messages or page after a disconnection
+
+
+class Backoff:
+    """
+    Exponential backoff with full jitter: the n-th delay is drawn uniformly
+    from [0, min(cap, base * factor ** n)].
+
+    Args:
+        base {float} - upper bound of the first delay in seconds
+        cap {float} - maximum delay in seconds
+        factor {float} - growth of the upper bound per attempt
+    """
+
+    def __init__(self, base: float = 0.05, cap: float = 0.5, factor: float = 2.0) -> None:
+        self.base = base
+        self.cap = cap
+        self.factor = factor
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        delay = random.uniform(0, min(self.cap, self.base * self.factor ** self.attempts))
+        self.attempts += 1
+        return delay
+
+    def reset(self) -> None:
+        self.attempts = 0
+
+
+class ConnectionManager:
+    """
+    Establishes TCP connections to a server, retrying with backoff and
+    keeping track of the health of the connection.
+
+    Args:
+        name {str} - name used in logs and metric labels
+        address {str} - host:port of the server
+        give_up_after {float} - seconds of continuous failure after which connect returns None
+        timeout {float} - timeout of the connected socket, None to block
+        connect_timeout {float} - timeout of each connection attempt
+        backoff {Backoff} - backoff between attempts
+    """
+
+    def __init__(self, name: str, address: str, give_up_after: float = 300.0, timeout: float = None,
+                 connect_timeout: float = 2.0, backoff: Backoff = None) -> None:
+        self.name = name
+        self.host, self.port = address.split(":")[0], int(address.split(":")[1])
+        self.give_up_after = give_up_after
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.healthy = False
+        self.failures = 0 # consecutive failures, reset on success
+        self.disconnected_at = None # perf_counter() when the last connection was lost
+        self._healthy = Connection_healthy.labels(name)
+        self._failures = Connection_failures_counter.labels(name)
+        self._reconnect_latency = Reconnect_latency.labels(name)
+
+    def connect(self, started: float = None) -> socket.socket:
+        """
+        Connects to the server, retrying until it succeeds or has been
+        failing for give_up_after seconds.
+
+        Args:
+            started {float} - perf_counter() time the give up deadline counts from,
+                by default when the connection was lost (or now)
+
+        Returns:
+            {socket.socket} - connected socket, or None if giving up
+        """
+        started = self._deadline_start(started)
+        while True:
+            try:
+                s = socket.create_connection((self.host, self.port), timeout=self.connect_timeout)
+            except OSError as e:
+                delay = self.attempt_failed(started, e)
+                if delay is None:
+                    return None
+                time.sleep(delay)
+                continue
+
+            s.settimeout(self.timeout)
+            self._connected()
+            return s
+
+    async def connect_async(self, started: float = None) -> tuple:
+        """
+        Same as connect but with asyncio streams, the event loop keeps
+        running other tasks while waiting to retry.
+
+        Args:
+            started {float} - perf_counter() time the give up deadline counts from, see connect
+
+        Returns:
+            {tuple} - (asyncio.StreamReader, asyncio.StreamWriter), or None if giving up
+        """
+        started = self._deadline_start(started)
+        while True:
+            try:
+                streams = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                delay = self.attempt_failed(started, e)
+                if delay is None:
+                    return None
+                await asyncio.sleep(delay)
+                continue
+
+            self._connected()
+            return streams
+
+    def closed(self, clean: bool) -> None:
+        """
+        Records that the connection was lost. After a clean close the next
+        connect is attempted straight away, after an error it is delayed by
+        the backoff.
+
+        Args:
+            clean {bool} - the server closed the connection gracefully
+        """
+        time.sleep(self._lost(clean))
+
+    async def closed_async(self, clean: bool) -> None:
+        """
+        Same as closed, without blocking the event loop.
+        """
+        await asyncio.sleep(self._lost(clean))
+
+    def attempt_failed(self, started: float, error: Exception) -> float:
+        """
+        Records a failed attempt, either to connect or to exchange a request
+        over an established connection, so both count towards giving up.
+
+        Args:
+            started {float} - perf_counter() time the give up deadline counts from
+            error {Exception} - why the attempt failed
+
+        Returns:
+            {float} - delay before the next attempt, None if it is time to give up
+        """
+        self._failed()
+        if self.disconnected_at is None:
+            self.disconnected_at = started
+        if perf_counter() - started >= self.give_up_after:
+            print(f"{self.name}: giving up after {self.failures} failed attempts")
+            return None
+        delay = self.backoff.next_delay()
+        print(f"{self.name}: attempt {self.failures} failed ({error}), retrying in {delay:.2f}s")
+        return delay
+
+    def _deadline_start(self, started: float) -> float:
+        if started is not None:
+            return started
+        return self.disconnected_at if self.disconnected_at is not None else perf_counter()
+
+    def _connected(self) -> None:
+        if self.disconnected_at is not None:
+            self._reconnect_latency.observe(perf_counter() - self.disconnected_at)
+        self.disconnected_at = None
+        self.healthy = True
+        self.failures = 0
+        self.backoff.reset()
+        self._healthy.set(1)
+
+    def _lost(self, clean: bool) -> float:
+        """
+        Returns how long to wait before reconnecting.
+        """
+        self.disconnected_at = perf_counter()
+        self.healthy = False
+        self._healthy.set(0)
+        if clean:
+            return 0
+        self._failed()
+        return self.backoff.next_delay()
+
+    def _failed(self) -> None:
+        self.failures += 1
+        self.healthy = False
+        self._failures.inc()
+        self._healthy.set(0)
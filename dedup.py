@@ -0,0 +1,78 @@
+"""
+Bounded index of recently processed LIMS messages.
+
+After a connection break the hospital resends every message that was not
+ACKed, some of which were already applied to the database. Each LIMS
+message is identified by a 64-bit hash of its MRN, MSH timestamp and OBX
+value, and the index remembers the most recent `capacity` of them so a
+replay is detected in O(1) without rescanning patient history. The keys
+are kept in a numpy ring buffer, which is what gets persisted with the
+database snapshot.
+
+"""
+
+import hashlib
+import numpy as np
+
+
+class DedupIndex:
+    """
+    Args:
+        capacity {int} - number of most recent messages remembered
+        keys {np.ndarray} - keys to restore, oldest first (e.g. from a snapshot)
+    """
+
+    def __init__(self, capacity: int = 100000, keys: np.ndarray = None) -> None:
+        if capacity < 1:
+            raise ValueError(f"Dedup index capacity must be at least 1, got {capacity}")
+        self.capacity = capacity
+        self._ring = np.zeros(capacity, dtype=np.uint64)
+        self._next = 0 # ring position of the next key
+        self._count = 0
+        self._seen = set()
+        if keys is not None:
+            for key in keys[-capacity:].tolist():
+                self.add(key)
+
+    @staticmethod
+    def message_key(mrn: str, message: list) -> int:
+        """
+        Identity of a LIMS message, stable across restarts (unlike hash()).
+
+        Args:
+            mrn {str} - patient mrn
+            message {list} - HL7 message from LIMS
+
+        Returns:
+            {int} - 64-bit key
+        """
+        timestamp = message[0].split("|")[6]
+        result = message[3].split("|")[5]
+        digest = hashlib.blake2b(f"{mrn}|{timestamp}|{result}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def __contains__(self, key: int) -> bool:
+        return key in self._seen
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, key: int) -> None:
+        if key in self._seen:
+            return
+        if self._count == self.capacity: # forget the oldest key
+            self._seen.discard(int(self._ring[self._next]))
+        else:
+            self._count += 1
+        self._ring[self._next] = key
+        self._seen.add(key)
+        self._next = (self._next + 1) % self.capacity
+
+    def to_array(self) -> np.ndarray:
+        """
+        Returns:
+            {np.ndarray} - uint64 keys, oldest first
+        """
+        if self._count < self.capacity:
+            return self._ring[:self._count].copy()
+        return np.roll(self._ring, -self._next)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Metrics layer of the AKI detection system.
+
+Counter increments made while handling a message are added up in a
+per-thread batch and applied to prometheus once, at the end of the loop
+iteration (flush), instead of taking the metric's lock on every update.
+The latency of every alert is observed in a Histogram per stage, which
+unlike a percentile Gauge can be aggregated across replicas, and the
+buckets of the blood distribution are derived from history.csv at startup.
+
+Run as a script to measure the cost of metrics in the hot path:
+
+    ./metrics.py benchmark
+
+"""
+
+import argparse
+import csv
+import os
+import threading
+import timeit
+import numpy as np
+from prometheus_client import REGISTRY, Counter, Gauge, Histogram
+from evaluation import CHECKPOINTS, STAGES
+
+# alert latencies range from tens of microseconds (parsing) to seconds (a pager outage)
+LATENCY_BUCKETS = [0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 3, 10]
+DEFAULT_BLOOD_BUCKETS = [80, 90, 105, 120, 140] # used when there is no history to derive them from
+
+Stage_latency = Histogram("Stage_latency", 'Time AKI alerts spent in each stage', ["stage"], buckets=LATENCY_BUCKETS)
+# Latency of parse, state update, inference, paging and total (received to paged) of every alert
+_stage_latency = {stage: Stage_latency.labels(stage) for stage in STAGES + ["total"]}
+Distribuition_bloods = None # created by set_blood_buckets
+# Produce a histogram of the blood counts recevied to identify anomolies or missprocessing e.g. 100% of bloods >140
+
+_local = threading.local()
+
+
+def inc(counter: Counter, amount: float = 1) -> None:
+    """
+    Records a counter increment, applied to prometheus by the next flush
+    of the calling thread.
+
+    Args:
+        counter {Counter} - counter to increment, labels already applied
+        amount {float} - amount to add
+    """
+    try:
+        pending = _local.pending
+    except AttributeError:
+        pending = _local.pending = {}
+    pending[counter] = pending.get(counter, 0) + amount
+
+def flush() -> None:
+    """
+    Applies the counter increments recorded by the calling thread. Called
+    at the end of every loop iteration and before shutting down.
+    """
+    pending = getattr(_local, "pending", None)
+    if pending:
+        for counter, amount in pending.items():
+            counter.inc(amount)
+        pending.clear()
+
+def observe_latencies(checkpoints: dict) -> None:
+    """
+    Observes the latency of every stage of an alert.
+
+    Args:
+        checkpoints {dict} - perf_counter() times the message passed each stage, see evaluation.CHECKPOINTS
+    """
+    times = [checkpoints.get(name) for name in CHECKPOINTS]
+    for stage, start, end in zip(STAGES, times, times[1:]):
+        if start is not None and end is not None:
+            _stage_latency[stage].observe(end - start)
+    _stage_latency["total"].observe(checkpoints["paged"] - checkpoints["received"])
+
+def select_buckets(data: list, n_buckets: int = 10) -> list:
+    """
+    Converts data to buckets for Prometheus client, with boundaries at
+    the quantiles of the data so every bucket holds a similar share of it.
+
+    Args:
+        data {list} - values to derive the buckets from
+        n_buckets {int} - number of buckets, fewer if quantiles coincide
+
+    Returns:
+        {list} - increasing bucket boundaries ending with +inf
+    """
+    quantiles = np.linspace(0, 1, n_buckets + 1)[1:-1]
+    boundaries = np.unique(np.round(np.quantile(data, quantiles), 1))
+    return boundaries.tolist() + [float("inf")]
+
+def blood_buckets_from_history(history_filename: str) -> list:
+    """
+    Args:
+        history_filename {str} - path to csv file of patient data
+
+    Returns:
+        {list} - buckets for the blood distribution, DEFAULT_BLOOD_BUCKETS if there is no history
+    """
+    if not os.path.exists(history_filename):
+        return DEFAULT_BLOOD_BUCKETS + [float("inf")]
+    results = []
+    with open(history_filename, "r") as f:
+        reader = csv.reader(f)
+        next(reader) # skip header
+        for row in reader:
+            results.extend(float(x) for x in row[2::2] if x != "")
+    if len(results) == 0:
+        return DEFAULT_BLOOD_BUCKETS + [float("inf")]
+    return select_buckets(results)
+
+def set_blood_buckets(buckets: list) -> None:
+    """
+    (Re)creates the blood distribution histogram with the given buckets.
+    """
+    global Distribuition_bloods
+    if Distribuition_bloods is not None:
+        REGISTRY.unregister(Distribuition_bloods)
+    Distribuition_bloods = Histogram("Distribuition_bloods", 'distribuitions of bloods', buckets=buckets)
+
+def observe_blood(result: float) -> None:
+    if Distribuition_bloods is None:
+        set_blood_buckets(DEFAULT_BLOOD_BUCKETS + [float("inf")])
+    Distribuition_bloods.observe(result)
+
+
+def benchmark(n: int) -> None:
+    """
+    Prints the cost per message of the metrics updated for a LIMS result
+    that triggers an alert, before and after this module.
+    """
+    counters = [Counter(f"Benchmark_counter_{i}", 'benchmark') for i in range(3)]
+    bloods = Histogram("Benchmark_bloods", 'benchmark', buckets=DEFAULT_BLOOD_BUCKETS + [float("inf")])
+    latency = Gauge("Benchmark_latency", 'benchmark')
+    checkpoints = {"received": 0.0, "parsed": 0.00002, "updated": 0.0002, "predicted": 0.002, "paged": 0.004}
+    times = []
+
+    def before(): # direct increments and a 99th percentile gauge over all response times
+        for counter in counters:
+            counter.inc()
+        bloods.observe(100.0)
+        times.append(checkpoints["paged"] - checkpoints["received"])
+        latency.set(np.percentile(times, 99))
+
+    def after():
+        for counter in counters:
+            inc(counter)
+        bloods.observe(100.0)
+        observe_latencies(checkpoints)
+        flush()
+
+    for name, update in [("before", before), ("after", after)]:
+        per_message = timeit.timeit(update, number=n) / n
+        print(f"{name}: {per_message * 1e6:.1f} us per alert over {n} alerts")
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("benchmark", help="Time metrics updates per message")
+    bench.add_argument("--messages", type=int, default=10000)
+    flags = parser.parse_args()
+    benchmark(flags.messages)
+
+if __name__ == "__main__":
+    main()
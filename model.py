@@ -1,20 +1,33 @@
 #!/usr/bin/env python3
 
 import argparse
-import sys
+import asyncio
+import bisect
+import calendar
 import signal
+import threading
 import socket
+import time
 import csv
+import functools
 import pickle
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import simulator
-from datetime import datetime
-import time
+from workers import WorkerPool
+from snapshot import save_snapshot, pack_snapshot, write_snapshot, load_state, load_dedup_keys, PeriodicSnapshots
+from dedup import DedupIndex
+from connection import ConnectionManager
+from async_runtime import AsyncPager, SnapshotWriter, read_mllp_message
+import metrics
+from evaluation import alerts_to_frame, report
+from pipeline import BoundedQueue, Stage, STOP, OVERLOAD_POLICIES, BLOCK, PRIORITIZE_LIMS, DEFER_PERSISTENCE, REJECT, MAX_DEFERRAL_SECONDS, Overload_counter
 from time import perf_counter
 import numpy as np
 import traceback
 import os
-from prometheus_client import Counter, Histogram, Gauge
+from prometheus_client import Counter
 from prometheus_client import start_http_server
 
 
@@ -25,6 +38,17 @@ ACK = [
     "MSH|^~\&|||||20240129093837||ACK|||2.5",
     "MSA|AA",
 ]
+REJECT_ACK = [ # application reject, the hospital will resend the message
+    "MSH|^~\&|||||20240129093837||ACK|||2.5",
+    "MSA|AR",
+]
+STATE_FILE = "/state/database.npz" # binary snapshot of the database, see snapshot.py
+LEGACY_STATE_FILE = "/state/database.pkl" # pickled database written by older versions
+PAGER_TIMEOUT_SECONDS = 10 # timeout waiting for the pager to respond
+PAGER_GIVE_UP_SECONDS = 30 # stop retrying a page after the pager has been failing this long
+SNAPSHOT_IDLE_SECONDS = 0.1 # shortest wait for messages before snapshotting the last changes
+_pager_connections = {} # (host, port) -> ConnectionManager, keeps pager health across pages
+DAY_SECONDS = 24 * 60 * 60
 MLLP_START_OF_BLOCK = 0x0b
 MLLP_END_OF_BLOCK = 0x1c
 MLLP_CARRIAGE_RETURN = 0x0d
@@ -40,32 +64,44 @@ Number_of_non_200_counter = Counter('Number_of_non_200_counter', 'Total number o
 #4: Number of times a non acknowledgment was sent by sockets being connected to
 Number_of_recconections_counter = Counter('Number_of_recconections_counter', 'Total number of reconnections')
 #5: Number of times a recconection has occured to the pager service
-Distribuition_bloods= Histogram("Distribuition_bloods", 'distribuitions of bloods',buckets=[80, 90, 105, 120,140, 'inf'])
-#6: Produce a histogram of the blood counts recevied to identify anomolies or missprocessing e.g. 100% of bloods >140
-Latency_times= Gauge("Latency_times", '99 percentile of time')
-# 99 percentile of the latency time between receiving a LIMs. processing it and then sending a pager if positive. 
+#6: Distribuition_bloods, buckets derived from history.csv at startup, see metrics.py
+#7: Stage_latency, histogram of the latency of each stage of an alert, see metrics.py
+Duplicate_messages_counter = Counter('Duplicate_messages_counter', 'Total number of resent LIMS messages skipped')
+#8: LIMS messages that were already processed before a reconnect and resent by the hospital
 
 
-def sigterm_handler(signum: int, frame: None, database: dict) -> None:
+class ShutdownRequested(Exception):
     """
-    Handles receiving a SIGTERM signal. Saves the 
-    database in its current state and exists the program
+    Raised by the SIGTERM handler to stop waiting for the hospital.
     """
-    with open("/state/database.pkl", "wb") as pkl:
-        pickle.dump(database, pkl)
-    sys.exit(0)
 
-def select_buckets(data):
+def sigterm_handler(signum: int, frame: None, shutdown: dict) -> None:
     """
-    Converts data to buckets for Prometheus client.
+    Handles receiving a SIGTERM signal. Asks main to stop reading messages,
+    interrupting it straight away if it is waiting for the hospital, so it
+    finishes the messages in progress and writes a final snapshot of the
+    database and the dedup index before exiting.
+
+    Args:
+        shutdown {dict} - "requested" is set here, "idle" is set by main while waiting for the hospital
     """
-    # Calculate quantiles to determine bucket boundaries
-    quantiles = np.linspace(0, 1, 6)
-    boundaries = np.quantile(data, quantiles)
+    print("SIGTERM received, shutting down")
+    shutdown["requested"] = True
+    if shutdown["idle"]:
+        raise ShutdownRequested()
 
-    # Convert boundaries to Prometheus bucket format
-    buckets = [float('-inf')] + list(boundaries[1:-1]) + [float('inf')]
-    return buckets
+def _wait_for_hospital(shutdown: dict, wait, *args):
+    """
+    Calls a function that waits for the hospital (connect, recv), which
+    SIGTERM interrupts with ShutdownRequested, see sigterm_handler.
+    """
+    shutdown["idle"] = True
+    try:
+        if shutdown["requested"]: # arrived before we started waiting
+            raise ShutdownRequested()
+        return wait(*args)
+    finally:
+        shutdown["idle"] = False
 
 def from_mllp(buffer: bytes) -> list: 
     """
@@ -96,6 +132,80 @@ def to_mllp(segments:list) -> bytes:
     return m
 
 
+def hl7_to_epoch(timestamp: str) -> float:
+    """
+    Converts an HL7 timestamp (YYYYmmddHHMM[SS]) to seconds since the
+    epoch, treating it as UTC. Much faster than datetime.strptime.
+
+    Args:
+        timestamp {str} - HL7 timestamp
+
+    Returns:
+        {float} - seconds since the epoch
+    """
+    return float(calendar.timegm((int(timestamp[0:4]), int(timestamp[4:6]), int(timestamp[6:8]),
+                                  int(timestamp[8:10] or 0), int(timestamp[10:12] or 0), int(timestamp[12:14] or 0))))
+
+def _history_to_epoch(date: str) -> float:
+    """
+    Converts a history.csv date (YYYY-mm-dd HH:MM:SS) to seconds since the epoch.
+    """
+    return float(calendar.timegm(datetime.fromisoformat(date).timetuple()))
+
+def add_result(patient: dict, date: float, result: float) -> None:
+    """
+    Adds a creatinine result to a patient, keeping results sorted by date
+    so results that arrive late still end up in the right place.
+
+    Args:
+        patient {dict} - patient entry of the database
+        date {float} - seconds since the epoch the sample was taken
+        result {float} - creatinine result
+    """
+    i = bisect.bisect_right(patient["dates"], date)
+    patient["dates"].insert(i, date)
+    patient["results"].insert(i, result)
+
+def _window(patient: dict, now: float, days: float) -> array:
+    """
+    Returns the results taken in the `days` days up to and including `now`,
+    found with two binary searches over the sorted dates.
+    """
+    dates = patient["dates"]
+    start = bisect.bisect_left(dates, now - days * DAY_SECONDS)
+    end = bisect.bisect_right(dates, now)
+    return patient["results"][start:end]
+
+def min_in_window(patient: dict, now: float, days: float = 7) -> float:
+    """
+    Lowest result in the last `days` days (the 7 day baseline for AKI).
+
+    Args:
+        patient {dict} - patient entry of the database
+        now {float} - seconds since the epoch
+        days {float} - length of the window
+
+    Returns:
+        {float} - lowest result, None if there are no results in the window
+    """
+    results = _window(patient, now, days)
+    return min(results) if results else None
+
+def median_in_window(patient: dict, now: float, days: float = 365) -> float:
+    """
+    Median result in the last `days` days (the 365 day baseline for AKI).
+
+    Args:
+        patient {dict} - patient entry of the database
+        now {float} - seconds since the epoch
+        days {float} - length of the window
+
+    Returns:
+        {float} - median result, None if there are no results in the window
+    """
+    results = _window(patient, now, days)
+    return float(np.median(results)) if results else None
+
 def _parse_history_file(database: dict, file_path: str) -> dict:
     """
     Parses a .txt file of PAS messages to update the current 
@@ -128,11 +238,12 @@ def _parse_history_file(database: dict, file_path: str) -> dict:
 def convert_history_to_dictionary(history_filename: str) -> dict:
     """
     Reads historical patient data stored in a persistant format
-    (e.g. pkl, csv or txt) and loads it into memory via a dict.
+    (e.g. npz, pkl, csv or txt) and loads it into memory via a dict.
 
     Has 2 modes of operation:
-        1. if a pkl file exists (e.g. from a previous runtime) then
-            load from there
+        1. if a snapshot exists (e.g. from a previous runtime) then
+            load from there, a database.pkl from older versions is
+            migrated to a snapshot
         2. otherwise (e.g. from a 'fresh' start) load from historical csv 
             file + backup.txt which contains all current hospital admissions 
     
@@ -145,26 +256,26 @@ def convert_history_to_dictionary(history_filename: str) -> dict:
     Returns:
         {dict} - dictionary of patient data
     """
-    if os.path.exists("/state/database.pkl"): # if pickle file exists then load from pickle
-        with open("/state/database.pkl", "rb") as pkl:  
-            database = pickle.load(pkl)
+    database = load_state(STATE_FILE, LEGACY_STATE_FILE) # load from snapshot if one exists
 
-    else: # otherwise load from original csv 
+    if database is None: # otherwise load from original csv 
         database = {}
         with open(history_filename, "r") as f:
             reader = csv.reader(f)
             next(reader) # skip header
             for row in reader:
+                history = sorted((_history_to_epoch(date), float(x)) for date, x in zip(row[1::2], row[2::2]) if x != "")
                 database[row[0]] = {
-                    "results": [float(x) for x in row[2:len(row):2] if x != ""]
+                    "dates": array('d', [date for date, _ in history]),
+                    "results": array('d', [x for _, x in history])
                 }
         database = _parse_history_file(database, "backup.txt")
-        with open("/state/database.pkl", "wb") as pkl:  # write to pickle for future use
-            pickle.dump(database, pkl)
+        save_snapshot(database, STATE_FILE) # write snapshot for future use
        
     return database
 
-def send_message(mrn: str, pager_host: str, pager_port: int) -> None:
+def send_message(mrn: str, pager_host: str, pager_port: int, give_up_after: float = PAGER_GIVE_UP_SECONDS,
+                 timeout: float = PAGER_TIMEOUT_SECONDS) -> None:
     """
     Sends message to pager containing mrn via HTTP request.
 
@@ -172,6 +283,8 @@ def send_message(mrn: str, pager_host: str, pager_port: int) -> None:
         mrn {str} - medical record number to send
         pager_host {str} - host name for pager
         pager_port {int} - port for pager
+        give_up_after {float} - seconds after which the page is dropped if it still hasn't gone through
+        timeout {float} - seconds to wait for the pager to respond
     Returns:
         None
     """
@@ -182,26 +295,35 @@ def send_message(mrn: str, pager_host: str, pager_port: int) -> None:
     request += "\r\n"
     request += f"{mrn}"
 
-    attempts = 0
-    max_attempts = 100
-
-    # Create a new socket for the pager server
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s_pager:
-
-        while attempts < max_attempts:
+    pager = _pager_connections.get((pager_host, pager_port))
+    if pager is None:
+        pager = ConnectionManager("pager", f"{pager_host}:{pager_port}", give_up_after=give_up_after, timeout=timeout)
+        _pager_connections[(pager_host, pager_port)] = pager
+
+    started = perf_counter() # failed connects and failed requests both count towards giving up
+    while True:
+        s_pager = pager.connect(started) # new connection for every request with HTTP/1.0
+        if s_pager is None:
+            print(f"Failed to page for MRN {mrn}!")
+            return
+        with s_pager:
             try:
-                s_pager.connect((pager_host, pager_port))  # Attempt to to the pager server
                 s_pager.sendall(request.encode())  # Send the HTTP request
                 response = s_pager.recv(1024)  # Receive response
-                break  
-            except (socket.error, socket.timeout): # retry 
-                print(f"Error sending to pager! Attempt {attempts}/{max_attempts} ")
-                attempts+=1
-                time.sleep(5)
-                
-        print("Paged successfully!")
-        if response.decode().split(" ")[1] !='200':
-            Number_of_non_200_counter.inc()
+                if len(response) == 0:
+                    raise ConnectionError("pager closed connection without a response")
+                break
+            except OSError as e: # retry with backoff
+                print(f"Error sending to pager! {e}")
+                delay = pager.attempt_failed(started, e)
+                if delay is None:
+                    print(f"Failed to page for MRN {mrn}!")
+                    return
+                time.sleep(delay)
+
+    print("Paged successfully!")
+    if response.decode().split(" ")[1] !='200':
+        metrics.inc(Number_of_non_200_counter)
 
 
 def pas_process(mrn: str, message: list, database: dict) -> None:
@@ -231,12 +353,13 @@ def pas_process(mrn: str, message: list, database: dict) -> None:
 
         else: # add new patient's information
             database[mrn] = {
-                "results": [],
+                "dates": array('d'),
+                "results": array('d'),
                 "sex": sex,
                 "age": age
             }
     
-def lims_process(patient_id: str, message: list, database: dict,Bloods:list) -> np.array:
+def lims_process(patient_id: str, message: list, database: dict) -> np.array:
     """
     Processes HL7 messages from LIMS, producing a np.array with age, gender and
     5 most recent test that can be used to inference with the model.
@@ -250,19 +373,20 @@ def lims_process(patient_id: str, message: list, database: dict,Bloods:list) ->
 
     """
     newest_test_result = float(message[3].split("|")[5]) # get test result
-    Bloods+=[newest_test_result]
-    Distribuition_bloods.observe(newest_test_result)
-    database[patient_id]["results"].append(newest_test_result) # add to database
+    test_date = hl7_to_epoch(message[2].split("|")[7]) # get time the sample was taken
+    metrics.observe_blood(newest_test_result)
+    add_result(database[patient_id], test_date, newest_test_result) # add to database
 
-    n = len(database[patient_id]["results"])
+    results = database[patient_id]["results"]
+    n = len(results)
 
     if n >= 5:
         # If there are more than 5 previous results, take the most recent 5
-        test_point = database[patient_id]["results"][-5:]
+        test_point = list(results[-5:])
     else:
         # If there are less than 5, pad with the mean
-        mean = np.mean(database[patient_id]["results"])
-        test_point = [mean for i in range(5-n)]+database[patient_id]["results"]
+        mean = np.mean(results)
+        test_point = [mean for i in range(5-n)]+list(results)
 
     if database[patient_id]["sex"] == 'M':
         # Insert a 1 for male to the begining of the test point
@@ -278,113 +402,413 @@ def lims_process(patient_id: str, message: list, database: dict,Bloods:list) ->
     # print(patient_id, test_point)
     return test_point
 
-def _evaluation(responses: dict, expected_aki_file: str) -> None:
+def _record_alert(responses: list, mrn: str, timestamp: str, checkpoints: dict) -> None:
     """
-    Runs evaluation on the inference performance including response
-    time for detecting akis and the number of akis detected. 
+    Records a paged AKI event for the latency metric and for evaluation.
 
     Args:
-        responses {dict} - patient mrn and response time for alterted aki events
-        expected_aki_file {str} - csv file with patient mrn who are expected to have an aki event
+        responses {list} - (mrn, HL7 timestamp, checkpoints) of paged aki events
+        mrn {str} - paged patient mrn
+        timestamp {str} - HL7 timestamp of the message that triggered the alert
+        checkpoints {dict} - perf_counter() times the message passed each stage, see evaluation.CHECKPOINTS
+    """
+    responses.append((mrn, timestamp, checkpoints))
+    metrics.observe_latencies(checkpoints)
+
+
+def build_pipeline(database: dict, trained_model, pager_address: str, responses: list, dedup: DedupIndex,
+                   snapshots: PeriodicSnapshots, policy: str = BLOCK, queue_size: int = 1000, start: bool = True) -> tuple:
+    """
+    Builds the state update, inference and paging stages of the pipeline,
+    connected by bounded queues. The decode stage is the socket loop in main,
+    which hands messages to the returned submit function.
+
+    With the prioritize-lims policy the state queue has a lane for LIMS
+    results, which the state update stage drains first, and a lane for PAS
+    updates, which wait at most MAX_DEFERRAL_SECONDS. LIMS results of a
+    patient with a PAS update waiting go in the PAS lane after it.
+
+    Unless snapshots are taken at an interval, submit waits until the state
+    update stage has applied the message and saved a snapshot, so an ACKed
+    message is never lost, and only inference and paging overlap with
+    reading the next message. The overload policies then have little to do.
+
+    Args:
+        database {dict} - database, only touched by the state update stage
+        trained_model - model used for inference
+        pager_address {str} - host:port of the pager
+        responses {list} - (mrn, HL7 timestamp, checkpoints) of paged aki events
+        dedup {DedupIndex} - processed LIMS messages, only touched by the state update stage,
+            which snapshots it with the database
+        snapshots {PeriodicSnapshots} - snapshots of the database, only used by the state update stage
+        policy {str} - overload policy, one of pipeline.OVERLOAD_POLICIES
+        queue_size {int} - size of each queue (and lane) between stages
+        start {bool} - start the stages
+
     Returns:
-        None - prints latency and accuracy metrics
-    
+        {tuple} - submit(is_PAS, mrn, message, checkpoints), which returns the ACK to send, and the list of stages
+    """
+    pager_host, pager_port = pager_address.split(":")[0], int(pager_address.split(":")[1])
+    if policy == PRIORITIZE_LIMS:
+        state_queue = BoundedQueue("state", queue_size, lanes=2, max_deferral=MAX_DEFERRAL_SECONDS)
+    else:
+        state_queue = BoundedQueue("state", queue_size)
+    inference_queue = BoundedQueue("inference", queue_size)
+    paging_queue = BoundedQueue("paging", queue_size)
+    pas_lane = {} # mrn -> number of messages of the patient in the PAS lane
+    pas_lane_lock = threading.Lock()
+
+    def submit(is_PAS, mrn, message, checkpoints):
+        lane = 0
+        if policy == PRIORITIZE_LIMS:
+            with pas_lane_lock:
+                if is_PAS or mrn in pas_lane: # keep the order of messages for this patient
+                    pas_lane[mrn] = pas_lane.get(mrn, 0) + 1
+                    lane = 1
+            if lane == 0 and not state_queue.empty(lane=1): # goes ahead of waiting PAS updates
+                metrics.inc(Overload_counter.labels(policy))
+        saved = threading.Event() if snapshots.interval is None else None # ACK once it is on disk
+        if not state_queue.put((is_PAS, mrn, message, checkpoints, lane, saved), block=policy != REJECT, lane=lane):
+            metrics.inc(Overload_counter.labels(REJECT))
+            return REJECT_ACK
+        if saved is not None:
+            saved.wait()
+        return ACK
+
+    def apply(is_PAS, mrn, message, checkpoints):
+        if not is_PAS:
+            key = DedupIndex.message_key(mrn, message)
+            if key in dedup: # resent after a reconnect, already processed
+                metrics.inc(Duplicate_messages_counter)
+                return
+        snapshots.mark_dirty()
+        if is_PAS:
+            pas_process(mrn, message, database)
+        else:
+            metrics.inc(Total_numbeer_blood_counter)
+            test_point = lims_process(mrn, message, database)
+            dedup.add(key) # only once it has been applied
+            checkpoints["updated"] = perf_counter()
+            inference_queue.put((mrn, message, test_point, checkpoints))
+
+    def update_state(item):
+        is_PAS, mrn, message, checkpoints, lane, saved = item
+        try:
+            try:
+                apply(is_PAS, mrn, message, checkpoints)
+            finally:
+                if lane == 1: # later LIMS results of this patient can go ahead again
+                    with pas_lane_lock:
+                        pas_lane[mrn] -= 1
+                        if pas_lane[mrn] == 0:
+                            del pas_lane[mrn]
+            if policy == DEFER_PERSISTENCE and state_queue.overloaded():
+                metrics.inc(Overload_counter.labels(policy))
+            else:
+                snapshots.maybe_save()
+        finally:
+            if saved is not None: # never leave the socket waiting
+                saved.set()
+
+    def infer(item):
+        mrn, message, test_point, checkpoints = item
+        prediction_num = trained_model.predict(test_point)[0]
+        checkpoints["predicted"] = perf_counter()
+        if prediction_num == 1: # if AKI detected
+            metrics.inc(Number_positive_counter)
+            paging_queue.put((mrn, message, checkpoints))
+
+    def page(item):
+        mrn, message, checkpoints = item
+        send_message(mrn, pager_host, pager_port)
+        checkpoints["paged"] = perf_counter()
+        _record_alert(responses, mrn, message[0].split("|")[6], checkpoints)
+
+    stages = [
+        Stage("state", state_queue, update_state, on_idle=snapshots.maybe_save, # snapshot the last changes once quiet
+              idle_timeout=None if snapshots.interval is None else max(snapshots.interval, SNAPSHOT_IDLE_SECONDS)),
+        Stage("inference", inference_queue, infer),
+        Stage("paging", paging_queue, page),
+    ]
+    if start:
+        for stage in stages:
+            stage.start()
+    return submit, stages
+
+def stop_pipeline(stages: list) -> None:
+    """
+    Stops the pipeline stages in order once they have processed everything
+    queued. The snapshots of the state update stage are then owned by the caller.
+    """
+    for stage in stages:
+        stage.inbox.put(STOP, lane=stage.inbox.lanes - 1) # after everything queued
+        stage.join()
+
+
+async def main_async(args, database: dict, trained_model, dedup: DedupIndex, responses: list) -> None:
+    """
+    Runs live inference on a single asyncio event loop. Messages are ACKed
+    as soon as the database is updated and saved, LIMS results are scored
+    in an executor thread and paged by concurrent tasks, and snapshots are
+    written in another executor thread, so reading the next message never
+    waits for the model or the pager. With --snapshot_interval messages are
+    ACKed before they are saved, so it doesn't wait for the disk either.
+
+    Args:
+        args - parsed command line arguments
+        database {dict} - database, only touched on the event loop
+        trained_model - model used for inference
+        dedup {DedupIndex} - processed LIMS messages, persisted with the database
+        responses {list} - (mrn, HL7 timestamp, checkpoints) of paged aki events
     """
-    times = [t for t in responses.values()] # response times when aki is detected
-    expected_akis = set() # patient id we expect an aki response from
-    reported_akis = {mrn for mrn in responses.keys()} # patient ids we alerted an aki response 
+    loop = asyncio.get_running_loop()
+    mllp = ConnectionManager("mllp", args.mllp_address, give_up_after=args.reconnect_timeout)
+    pager = AsyncPager(args.pager_address, give_up_after=PAGER_GIVE_UP_SECONDS, timeout=PAGER_TIMEOUT_SECONDS)
+    scoring = ThreadPoolExecutor(1, thread_name_prefix="scoring") # one thread keeps results of a patient in order
+    persistence = ThreadPoolExecutor(1, thread_name_prefix="persistence")
+    snapshots = SnapshotWriter(lambda: pack_snapshot(database, dedup.to_array()),
+                               lambda arrays: write_snapshot(arrays, STATE_FILE), persistence, args.snapshot_interval or 0.0)
+    in_flight = asyncio.Semaphore(args.queue_size) # results being scored or paged, stops reading when full
+    tasks = set()
+
+    async def score(mrn, message, test_point, checkpoints):
+        try:
+            prediction_num = (await loop.run_in_executor(scoring, trained_model.predict, test_point))[0] # inference
+            checkpoints["predicted"] = perf_counter()
+            if prediction_num == 1: # if AKI detected
+                metrics.inc(Number_positive_counter)
+                status = await pager.page(mrn)
+                if status is None:
+                    print(f"Failed to page for MRN {mrn}!")
+                    return
+                print("Paged successfully!")
+                if status != 200:
+                    metrics.inc(Number_of_non_200_counter)
+                checkpoints["paged"] = perf_counter()
+                _record_alert(responses, mrn, message[0].split("|")[6], checkpoints)
+        finally:
+            in_flight.release()
+            metrics.flush()
+
+    async def ingest():
+        while True:
+            streams = await mllp.connect_async()  # establish IPv4 TCP connection with MLLP
+            if streams is None:
+                return
+            print("Connection established!")
+            reader, writer = streams
 
-    # report latency metrics 
-    print(f"Mean: {np.mean(times)}")
-    print(f"90th percentile: {np.percentile(times, 90)}")
-    print(f"Number of aki events: {len(times)}")
+            try: # with connection established
+                while True: # run inference loop
+                    buffer = await read_mllp_message(reader)  # read one framed message
+                    st = perf_counter()  # start timer
 
-    # report accuracy metrics 
-    with open(expected_aki_file) as csvfile:
-        reader = csv.reader(csvfile)
-        for row in reader:
-            expected_akis.add(row[0])
-    print(f"Missing aki events: {len(expected_akis-reported_akis)}")
-    print(f"Incorrect aki events: {len(reported_akis-expected_akis)}")
+                    if len(buffer) == 0:  # breaks if connection is closed
+                        await mllp.closed_async(clean=True) # reconnect straight away
+                        break
 
+                    try:
+                        message = from_mllp(buffer)  # remove MLLP framing
+                        metrics.inc(Total_messages_counter)
+                        is_PAS = True if ("ADT" in message[0].split("|")[8]) else False  # determine message type
+                        mrn = message[1].split("|")[3]
+                        checkpoints = {"received": st, "parsed": perf_counter()}
+                        key = None if is_PAS else DedupIndex.message_key(mrn, message)
+
+                        if key is not None and key in dedup: # resent after a reconnect, already processed
+                            metrics.inc(Duplicate_messages_counter)
+                        elif is_PAS:
+                            pas_process(mrn, message, database) # process PAS message
+                            snapshots.mark_dirty()
+                        else:
+                            metrics.inc(Total_numbeer_blood_counter)
+                            test_point = lims_process(mrn, message, database) # process LIMS message
+                            dedup.add(key) # only once it has been applied
+                            checkpoints["updated"] = perf_counter()
+                            snapshots.mark_dirty()
+                            await in_flight.acquire()
+                            task = asyncio.create_task(score(mrn, message, test_point, checkpoints))
+                            tasks.add(task)
+                            task.add_done_callback(tasks.discard)
+
+                    except Exception as e:
+                        print(f"Error processing message! {e}")
+
+                    if args.snapshot_interval is None: # never ACK what a crash would lose
+                        await snapshots.flush()
+                    writer.write(to_mllp(ACK))
+                    await writer.drain()
+                    metrics.flush()
+
+            except OSError as e: # catch errors breaking connection
+                print(f"Connection broke! {e}")
+                await mllp.closed_async(clean=False)
+            finally:
+                writer.close()
+
+    ingestion = asyncio.create_task(ingest())
+    loop.add_signal_handler(signal.SIGTERM, ingestion.cancel) # stop reading, then finish up below
+    try:
+        await ingestion
+    except asyncio.CancelledError:
+        if not ingestion.cancelled():
+            raise
+        print("SIGTERM received, shutting down")
+
+    await asyncio.gather(*tasks) # finish scoring and paging what was received
+    await snapshots.flush()
+    scoring.shutdown()
+    persistence.shutdown()
+
+def _write_evaluation(responses: list) -> None:
+    """
+    Writes the alerts of the run to alerts.csv and reports them against aki.csv.
+    """
+    alerts = alerts_to_frame(responses)
+    alerts.to_csv("alerts.csv", index=False) # can be evaluated again with evaluation.py
+    report(alerts, "aki.csv")
 
-signal.signal(signal.SIGTERM, sigterm_handler) # init sigterm handler
 
 def main(args):
     """
     Runs live inference with the AKI detection system
 
     """
-    # prometheus logging
-    Times=[]
-    Bloods=[]
+    metrics.set_blood_buckets(metrics.blood_buckets_from_history("/hospital-history/history.csv"))
 
-    # attempts for time out condition
-    attempts = 0
-    max_attempts = 100
+    # reconnects with backoff, gives up if the hospital is unreachable for too long, and with
+    # periodic snapshots stops waiting for messages while the hospital is quiet to snapshot the last changes
+    idle_timeout = None
+    if args.snapshot_interval is not None and not args.pipeline:
+        idle_timeout = max(args.snapshot_interval, SNAPSHOT_IDLE_SECONDS)
+    mllp = ConnectionManager("mllp", args.mllp_address, give_up_after=args.reconnect_timeout, timeout=idle_timeout)
 
-    responses = {}  # track aki events with patient numbers and response times for evaluation
+    responses = []  # track aki events with patient numbers, timestamps and stage times for evaluation
     with open('trained_model.pkl', 'rb') as file:  # load model
         trained_model = pickle.load(file)
 
     database = convert_history_to_dictionary("/hospital-history/history.csv")  # load historical data 
-    while attempts < max_attempts:
+    dedup = DedupIndex(args.dedup_capacity, load_dedup_keys(STATE_FILE))  # LIMS messages already processed
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:  # create IPv4 TCP socket with MLLP
-            
-            try:
-                s.connect((args.mllp_address.split(":")[0], int(args.mllp_address.split(":")[1])))  # establish connection
-                print("Connection established!")
+    if args.asyncio: # multiplex ingestion, paging and snapshots on one event loop
+        asyncio.run(main_async(args, database, trained_model, dedup, responses))
+        metrics.flush()
+        if args.evaluate: # evaluation mode
+            _write_evaluation(responses)
+        return
 
-            except (socket.error, socket.timeout) as e: # catch errors establishing connection
-                print(f"Failure establishing connection! Attempt {attempts}/{max_attempts} to reconnect...")
-                time.sleep(3)
-                attempts += 1
-                continue
+    snapshots = PeriodicSnapshots(lambda: pack_snapshot(database, dedup.to_array()),
+                                  lambda arrays: write_snapshot(arrays, STATE_FILE), args.snapshot_interval)
 
-            try: # with connection established 
+    pool = None
+    if args.workers > 0: # shard inference to worker processes
+        pager_host, pager_port = args.pager_address.split(":")[0], int(args.pager_address.split(":")[1])
+        paging = ThreadPoolExecutor(args.workers, thread_name_prefix="paging") # a slow page doesn't hold up the others
 
-                while True: # run inference loop
-                    buffer = s.recv(1024)  # read stream 
-                    st = perf_counter()  # start timer
+        def page(mrn, timestamp, checkpoints): # in this process, so the metrics are scraped
+            metrics.inc(Number_positive_counter)
+            send_message(mrn, pager_host, pager_port)
+            checkpoints["paged"] = perf_counter()
+            _record_alert(responses, mrn, timestamp, checkpoints)
+            metrics.flush()
 
-                    if len(buffer) == 0:  # breaks if connection is closed
-                        break
+        pool = WorkerPool(args.workers, trained_model, lambda *alert: paging.submit(page, *alert))
+        pool.start()
+
+    submit = None
+    if args.pipeline: # run stages in threads connected by bounded queues
+        submit, stages = build_pipeline(database, trained_model, args.pager_address, responses,
+                                        dedup, snapshots, args.overload_policy, args.queue_size)
+
+    shutdown = {"requested": False, "idle": False}
+    signal.signal(signal.SIGTERM, functools.partial(sigterm_handler, shutdown=shutdown)) # init sigterm handler
+
+    try:
+        while True:
+
+            s = _wait_for_hospital(shutdown, mllp.connect)  # establish IPv4 TCP connection with MLLP
+            if s is None:
+                break
+            print("Connection established!")
+
+            with s:
+
+                try: # with connection established 
+
+                    while True: # run inference loop
+                        try:
+                            buffer = _wait_for_hospital(shutdown, s.recv, 1024)  # read stream 
+                        except socket.timeout: # hospital is quiet
+                            snapshots.maybe_save()
+                            continue
+                        st = perf_counter()  # start timer
+
+                        if len(buffer) == 0:  # breaks if connection is closed
+                            mllp.closed(clean=True) # reconnect straight away
+                            break
                     
-                    try: 
+                        ack = ACK
+                        try: 
                         
-                        message = from_mllp(buffer)  # remove MLLP framing
-                        Total_messages_counter.inc()
-                        is_PAS = True if ("ADT" in message[0].split("|")[8]) else False  # determine message type
-                        mrn = message[1].split("|")[3]
-
-                        if is_PAS: 
-                            pas_process(mrn, message, database) # process PAS message
-                        else:  
-                            Total_numbeer_blood_counter.inc()
-                            test_point = lims_process(mrn, message, database, Bloods) # process LIMS message
-                            
-                            prediction_num = trained_model.predict(test_point)[0] # inference
-                            if prediction_num == 1: #if AKI detected
-                                Number_positive_counter.inc()
-                                send_message(mrn, args.pager_address.split(":")[0], int(args.pager_address.split(":")[1])) # send message to pager via HTTP
-                                response_time = perf_counter() - st # calculate response time
-                                Times+=[response_time]
-                                responses[mrn] = response_time
-                                response_time=Latency_times.set(np.percentile(Times, 99))
-
-                    except:
-                        pass
-
-                    pickle.dump(database, open("/state/database.pkl", 'wb'))
-                    s.sendall(to_mllp(ACK))
-        
-            except (socket.timeout, socket.error): # catch errors breaking connection
-                print(f"Connection broke!")
-                time.sleep(2)
+                            message = from_mllp(buffer)  # remove MLLP framing
+                            metrics.inc(Total_messages_counter)
+                            is_PAS = True if ("ADT" in message[0].split("|")[8]) else False  # determine message type
+                            mrn = message[1].split("|")[3]
+                            checkpoints = {"received": st, "parsed": perf_counter()}
+                            key = None if is_PAS or submit is not None else DedupIndex.message_key(mrn, message)
+                            test_point = None # set for a LIMS result to score
+
+                            if submit is not None: # hand over to the pipeline, which skips resent messages
+                                ack = submit(is_PAS, mrn, message, checkpoints)
+                            elif key is not None and key in dedup: # resent after a reconnect, already processed
+                                metrics.inc(Duplicate_messages_counter)
+                            elif is_PAS: 
+                                pas_process(mrn, message, database) # process PAS message
+                                snapshots.mark_dirty()
+                            else:
+                                metrics.inc(Total_numbeer_blood_counter)
+                                test_point = lims_process(mrn, message, database) # process LIMS message
+                                dedup.add(key) # only once it has been applied
+                                checkpoints["updated"] = perf_counter()
+                                snapshots.mark_dirty()
+
+                            if pool is not None and test_point is not None: # scored by the worker this mrn is sharded to
+                                pool.submit(mrn, test_point, message[0].split("|")[6], checkpoints)
+                            elif test_point is not None:
+                                prediction_num = trained_model.predict(test_point)[0] # inference
+                                checkpoints["predicted"] = perf_counter()
+                                if prediction_num == 1: #if AKI detected
+                                    metrics.inc(Number_positive_counter)
+                                    send_message(mrn, args.pager_address.split(":")[0], int(args.pager_address.split(":")[1])) # send message to pager via HTTP
+                                    checkpoints["paged"] = perf_counter()
+                                    _record_alert(responses, mrn, message[0].split("|")[6], checkpoints)
+
+                        except:
+                            pass
+
+                        if submit is None: # the pipeline snapshots from its state stage
+                            snapshots.maybe_save() # before the ACK unless --snapshot_interval is set
+                        s.sendall(to_mllp(ack))
+                        metrics.flush()
         
+                except OSError as e: # catch errors breaking connection
+                    print(f"Connection broke! {e}")
+                    mllp.closed(clean=False)
+    except ShutdownRequested:
+        pass # finish up below
+
+    if submit is not None:
+        stop_pipeline(stages)
+
+    if pool is not None:
+        pool.stop()
+        paging.shutdown() # last alerts
+
+    snapshots.close() # last changes
+    metrics.flush()
+
     if args.evaluate: # evaluation mode
-        _evaluation(responses, "aki.csv")
+        _write_evaluation(responses)
 
 if __name__ == "__main__":
     
@@ -397,5 +821,17 @@ if __name__ == "__main__":
     parser.add_argument("--pager_address", type=str, default=PAGER_ADDRESS)
     parser.add_argument("--evaluate", type=bool, default=False)
     parser.add_argument("--model", type=str, default="trained_model.pkl")
+    parser.add_argument("--workers", type=int, default=0, help="Number of inference worker processes, 0 runs inference in the main process")
+    parser.add_argument("--dedup_capacity", type=int, default=100000, help="Number of recent LIMS messages remembered to skip resent messages")
+    parser.add_argument("--reconnect_timeout", type=float, default=300, help="Seconds without a connection to the hospital after which the system stops")
+    parser.add_argument("--pipeline", action="store_true", help="Run decode, state update, inference and paging as separate stages with bounded queues")
+    parser.add_argument("--overload_policy", type=str, default=BLOCK, choices=OVERLOAD_POLICIES, help="What gives way when the pipeline queues are full")
+    parser.add_argument("--queue_size", type=int, default=1000, help="Size of each queue between pipeline stages, or with --asyncio the number of results being scored or paged at once")
+    parser.add_argument("--asyncio", action="store_true", help="Run ingestion, paging and snapshots concurrently on one asyncio event loop")
+    parser.add_argument("--snapshot_interval", type=float, default=None, help="Take database snapshots in the background at most this many seconds apart instead of before every ACK, faster but updates since the last snapshot are lost on a crash")
     args = parser.parse_args()
+    if sum([args.pipeline, args.workers > 0, args.asyncio]) > 1:
+        parser.error("only one of --pipeline, --workers and --asyncio can be used")
+    if args.dedup_capacity < 1:
+        parser.error("--dedup_capacity must be at least 1")
     main(args)
\ No newline at end of file
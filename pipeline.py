@@ -0,0 +1,172 @@
+"""
+Bounded queues and stage threads used to run the AKI detection system as
+a pipeline (decode -> state update -> inference -> paging).
+
+Every queue between stages has a fixed size so a slow stage pushes back
+on the one before it instead of buffering without limit, and the
+overload policy decides what gives way when the queues fill up. A queue
+can have several lanes, each with its own size: the stage takes from the
+first lane that has items, unless an item of a later lane has been
+waiting for longer than max_deferral.
+
+"""
+
+import collections
+import queue
+import threading
+from time import perf_counter
+from prometheus_client import Counter, Gauge, Histogram
+import metrics
+
+# Overload policies
+BLOCK = "block" # block the socket until there is space (TCP backpressure)
+PRIORITIZE_LIMS = "prioritize-lims" # apply LIMS results ahead of waiting PAS updates
+DEFER_PERSISTENCE = "defer-persistence" # skip database snapshots while overloaded
+REJECT = "reject" # send an MLLP application-reject ACK so the hospital resends later
+OVERLOAD_POLICIES = [BLOCK, PRIORITIZE_LIMS, DEFER_PERSISTENCE, REJECT]
+
+STOP = object() # sentinel to shut a stage down
+MAX_DEFERRAL_SECONDS = 1.0 # longest a PAS update waits behind LIMS results with prioritize-lims
+
+Queue_depth = Gauge("Queue_depth", 'Number of items waiting between pipeline stages', ["queue"])
+# Depth of each of the bounded queues
+Queue_wait_times = Histogram("Queue_wait_times", 'Time items wait in a queue before being processed', ["queue"],
+                             buckets=[0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5])
+# How long messages sit in each queue, a growing wait means a stage can't keep up
+Overload_counter = Counter("Overload_counter", 'Number of times the overload policy was applied', ["policy"])
+# Messages rejected, LIMS results applied ahead of PAS updates or snapshots skipped because of overload
+
+
+class BoundedQueue:
+    """
+    Fixed size queue that reports its depth and wait times. Items are
+    taken in FIFO order within a lane and from the first non-empty lane,
+    see the module docstring.
+
+    Args:
+        name {str} - name used for the metric labels
+        maxsize {int} - maximum number of items in each lane
+        high_watermark {float} - fraction of maxsize at which a lane counts as overloaded
+        lanes {int} - number of lanes
+        max_deferral {float} - seconds after which an item of a later lane is taken first, None to never
+    """
+
+    def __init__(self, name: str, maxsize: int, high_watermark: float = 0.8, lanes: int = 1,
+                 max_deferral: float = None) -> None:
+        self.name = name
+        self.maxsize = maxsize
+        self.high_watermark = max(1, int(maxsize * high_watermark))
+        self.lanes = lanes
+        self.max_deferral = max_deferral
+        self._lanes = [collections.deque() for _ in range(lanes)] # (enqueued, item)
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._depth = Queue_depth.labels(name)
+        self._wait = Queue_wait_times.labels(name)
+
+    def put(self, item, block: bool = True, lane: int = 0) -> bool:
+        """
+        Adds an item to a lane of the queue.
+
+        Args:
+            item - item to add
+            block {bool} - wait for space if the lane is full
+            lane {int} - lane to add the item to
+
+        Returns:
+            {bool} - False if the lane was full and block is False
+        """
+        with self._not_full:
+            while len(self._lanes[lane]) >= self.maxsize:
+                if not block:
+                    return False
+                self._not_full.wait()
+            self._lanes[lane].append((perf_counter(), item))
+            self._depth.set(self._size())
+            self._not_empty.notify()
+        return True
+
+    def get(self, timeout: float = None):
+        """
+        Removes the next item, raising queue.Empty if there is none within timeout seconds.
+        """
+        with self._not_empty:
+            if not self._not_empty.wait_for(self._size, timeout):
+                raise queue.Empty
+            enqueued, item = self._next_lane().popleft()
+            self._depth.set(self._size())
+            self._not_full.notify_all() # waiters may be waiting on different lanes
+        self._wait.observe(perf_counter() - enqueued)
+        return item
+
+    def _next_lane(self) -> collections.deque:
+        if self.max_deferral is not None:
+            now = perf_counter()
+            for lane in self._lanes[1:]:
+                if lane and now - lane[0][0] >= self.max_deferral:
+                    return lane
+        return next(lane for lane in self._lanes if lane)
+
+    def _size(self) -> int:
+        return sum(len(lane) for lane in self._lanes)
+
+    def empty(self, lane: int = None) -> bool:
+        """
+        Args:
+            lane {int} - lane to check, all of them by default
+        """
+        with self._lock:
+            return len(self._lanes[lane]) == 0 if lane is not None else self._size() == 0
+
+    def overloaded(self) -> bool:
+        with self._lock:
+            return any(len(lane) >= self.high_watermark for lane in self._lanes)
+
+
+class Stage(threading.Thread):
+    """
+    Thread that applies a handler to every item of its inbox until STOP
+    is received with nothing left in the inbox. Errors are reported and the stage carries on, as a bad
+    message must not stop the pipeline.
+
+    Args:
+        name {str} - name of the stage
+        inbox {BoundedQueue} - queue the stage reads from
+        handler {callable} - called with each item
+        on_idle {callable} - optional, called whenever the inbox is empty
+        idle_timeout {float} - optional, also call on_idle every idle_timeout seconds while the inbox stays empty
+    """
+
+    def __init__(self, name: str, inbox: BoundedQueue, handler, on_idle=None, idle_timeout: float = None) -> None:
+        super().__init__(name=name, daemon=True)
+        self.inbox = inbox
+        self.handler = handler
+        self.on_idle = on_idle
+        self.idle_timeout = idle_timeout if on_idle is not None else None
+
+    def run(self) -> None:
+        while True:
+            try:
+                item = self.inbox.get(self.idle_timeout)
+            except queue.Empty:
+                try:
+                    self.on_idle()
+                except Exception as e:
+                    print(f"{self.name}: error while idle: {e}")
+                continue
+            if item is STOP:
+                if self.inbox.empty():
+                    break
+                self.inbox.put(STOP, lane=self.inbox.lanes - 1) # an overdue later lane went first, finish the rest
+                continue
+            try:
+                self.handler(item)
+                if self.on_idle is not None and self.inbox.empty():
+                    self.on_idle()
+            except Exception as e:
+                print(f"{self.name}: error processing message: {e}")
+            metrics.flush() # counters updated by this stage
+        if self.on_idle is not None:
+            self.on_idle()
+        metrics.flush()
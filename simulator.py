@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import mmap
 import socket
 import threading
 import http.server
@@ -10,19 +11,17 @@ MLLP_BUFFER_SIZE = 1024
 MLLP_TIMEOUT_SECONDS = 10
 SHUTDOWN_POLL_INTERVAL_SECONDS = 2
 
-def serve_mllp_client(client, source, messages, shutdown_mllp):
+def serve_mllp_client(client, source, messages, shutdown_mllp, quiet=False):
     i = 0
     buffer = b""
     while i < len(messages) and not shutdown_mllp.is_set():
         try:
-            mllp = bytes(chr(MLLP_START_OF_BLOCK), "ascii")
-            mllp += messages[i]
-            mllp += bytes(chr(MLLP_END_OF_BLOCK) + chr(MLLP_CARRIAGE_RETURN), "ascii")
-            client.sendall(mllp)
+            client.sendall(messages[i]) # messages are already MLLP framed
             received = []
             while len(received) < 1:
                 r = client.recv(MLLP_BUFFER_SIZE)
-                print(f'recieved = {r}')
+                if not quiet:
+                    print(f'recieved = {r}')
                 if len(r) == 0:
                     raise Exception("client closed connection")
                 buffer += r
@@ -32,7 +31,7 @@ def serve_mllp_client(client, source, messages, shutdown_mllp):
                 raise Exception(error)
             elif acked:
                 i += 1
-            else:
+            elif not quiet:
                 print(f"mllp: {source}: message not acknowledged")
         except Exception as e:
             print(f"mllp: {source}: {e}")
@@ -62,7 +61,7 @@ def verify_ack(messages):
         return False, "Wrong number of fields in MSA segment"
     return fields[HL7_MSA_ACK_CODE_FIELD] == HL7_MSA_ACK_CODE_ACCEPT, None
 
-def run_mllp_server(host, port, hl7_messages, shutdown_mllp):
+def run_mllp_server(host, port, hl7_messages, shutdown_mllp, quiet=False):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         s.bind((host, port))
@@ -77,48 +76,57 @@ def run_mllp_server(host, port, hl7_messages, shutdown_mllp):
             source = f"{host}:{port}"
             print(f"mllp: {source}: accepted connection")
             client.settimeout(MLLP_TIMEOUT_SECONDS)
-            t = threading.Thread(target=serve_mllp_client, args=(client, source, hl7_messages, shutdown_mllp), daemon=True)
+            t = threading.Thread(target=serve_mllp_client, args=(client, source, hl7_messages, shutdown_mllp, quiet), daemon=True)
             t.start()
         print("mllp: graceful shutdown")
 
 MLLP_START_OF_BLOCK = 0x0b
 MLLP_END_OF_BLOCK = 0x1c
 MLLP_CARRIAGE_RETURN = 0x0d
+MLLP_END_OF_BLOCK_BYTES = bytes([MLLP_END_OF_BLOCK])
 
-def parse_mllp_messages(buffer, source):
-    i = 0
-    messages = []
+# Returns the (start, end) offsets of the complete MLLP frames in buffer and
+# the offset of the first unconsumed byte. buffer can be bytes or an mmap.
+def find_mllp_frames(buffer, source):
+    frames = []
     consumed = 0
-    expect = MLLP_START_OF_BLOCK
-    while i < len(buffer):
-        if expect is not None:
-            if buffer[i] != expect:
-                raise Exception(f"{source}: bad MLLP encoding: want {hex(expect)}, found {hex(buffer[i])}")
-            if expect == MLLP_START_OF_BLOCK:
-                expect = None
-                consumed = i
-            elif expect == MLLP_CARRIAGE_RETURN:
-                messages.append(buffer[consumed+1:i-1])
-                expect = MLLP_START_OF_BLOCK
-                consumed = i + 1
-        else:
-            if buffer[i] == MLLP_END_OF_BLOCK:
-                expect = MLLP_CARRIAGE_RETURN
-        i += 1
+    end = len(buffer)
+    while consumed < end:
+        if buffer[consumed] != MLLP_START_OF_BLOCK:
+            raise Exception(f"{source}: bad MLLP encoding: want {hex(MLLP_START_OF_BLOCK)}, found {hex(buffer[consumed])}")
+        i = buffer.find(MLLP_END_OF_BLOCK_BYTES, consumed + 1)
+        if i < 0 or i + 1 >= end: # incomplete frame
+            break
+        if buffer[i+1] != MLLP_CARRIAGE_RETURN:
+            raise Exception(f"{source}: bad MLLP encoding: want {hex(MLLP_CARRIAGE_RETURN)}, found {hex(buffer[i+1])}")
+        frames.append((consumed, i + 2))
+        consumed = i + 2
+    return frames, consumed
+
+def parse_mllp_messages(buffer, source):
+    frames, consumed = find_mllp_frames(buffer, source)
+    messages = [buffer[start+1:end-2] for start, end in frames]
     return messages, buffer[consumed:]
 
-def read_hl7_messages(filename):
+# Memory maps an MLLP file and returns zero-copy views of each framed message,
+# ready to be sent without building the framing again.
+def read_framed_messages(filename):
     with open(filename, "rb") as r:
-        messages, remaining = parse_mllp_messages(r.read(), filename)
-        if len(remaining) > 0:
-                print(f"messages: {len(messages)} remaining: {len(remaining)}")
-                raise Exception(f"{filename}: Unexpected data at end of file")
-        return messages
+        if r.seek(0, 2) == 0:
+            return []
+        mapped = mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ)
+    frames, consumed = find_mllp_frames(mapped, filename)
+    if consumed != len(mapped):
+        print(f"messages: {len(frames)} remaining: {len(mapped) - consumed}")
+        raise Exception(f"{filename}: Unexpected data at end of file")
+    view = memoryview(mapped)
+    return [view[start:end] for start, end in frames]
 
 class PagerRequestHandler(http.server.BaseHTTPRequestHandler):
 
-    def __init__(self, shutdown, *args, **kwargs):
+    def __init__(self, shutdown, *args, quiet=False, **kwargs):
         self.shutdown = shutdown
+        self.quiet = quiet
         super().__init__(*args, **kwargs)
 
     def do_POST(self):
@@ -140,7 +148,8 @@ class PagerRequestHandler(http.server.BaseHTTPRequestHandler):
                 self.send_response(http.HTTPStatus.BAD_REQUEST, "Bad MRN in body")
                 self.end_headers()
                 return
-            print(f"pager: paging for MRN {mrn}")
+            if not self.quiet:
+                print(f"pager: paging for MRN {mrn}")
             self.send_response(http.HTTPStatus.OK)
             self.send_header("Content-Type", "text/plain")
             self.end_headers()
@@ -172,11 +181,12 @@ def main():
     parser.add_argument("--messages", default="messages.mllp", help="HL7 messages to replay, in MLLP format")
     parser.add_argument("--mllp", default=8440, type=int, help="Port on which to replay HL7 messages via MLLP")
     parser.add_argument("--pager", default=8441, type=int, help="Post on which to listen for pager requests via HTTP")
+    parser.add_argument("--quiet", action="store_true", help="Don't log every ACK and page, for use as a load driver")
     flags = parser.parse_args()
-    hl7_messages = read_hl7_messages(flags.messages)
+    hl7_messages = read_framed_messages(flags.messages)
     shutdown_mllp = threading.Event()
     print(len(hl7_messages))
-    t = threading.Thread(target=run_mllp_server, args=("0.0.0.0", flags.mllp, hl7_messages, shutdown_mllp), daemon=True)
+    t = threading.Thread(target=run_mllp_server, args=("0.0.0.0", flags.mllp, hl7_messages, shutdown_mllp, flags.quiet), daemon=True)
     t.start()
     pager = None
     def shutdown():
@@ -184,7 +194,7 @@ def main():
         print("pager: graceful shutdown")
         pager.shutdown()
     def new_pager_handler(*args, **kwargs):
-        return PagerRequestHandler(shutdown, *args, **kwargs)
+        return PagerRequestHandler(shutdown, *args, quiet=flags.quiet, **kwargs)
     pager = http.server.ThreadingHTTPServer(("0.0.0.0", flags.pager), new_pager_handler)
     print(f"pager: listening on 0.0.0.0:{flags.pager}")
     pager.serve_forever(poll_interval=SHUTDOWN_POLL_INTERVAL_SECONDS)
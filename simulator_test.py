@@ -36,6 +36,11 @@ ACK = [
     "MSA|AA",
 ]
 
+REJECT_ACK = [
+    "MSH|^~\&|||||20240129093837||ACK|||2.5",
+    "MSA|AR",
+]
+
 def wait_until_healthy(p, http_address):
     max_attempts = 20
     for _ in range(max_attempts):
@@ -121,6 +126,18 @@ class SimulatorTest(unittest.TestCase):
         for i in range(1, len(runs)):
             self.assertEqual(runs[i], runs[0])
 
+    def test_rejected_messages_are_resent(self):
+        messages = []
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.connect(("localhost", TEST_MLLP_PORT))
+            while True:
+                buffer = s.recv(1024)
+                if len(buffer) == 0:
+                    break
+                messages.append(from_mllp(buffer))
+                s.sendall(to_mllp(REJECT_ACK if messages.count(messages[-1]) == 1 else ACK))
+        self.assertEqual(messages, [ADT_A01, ADT_A01, ORU_R01, ORU_R01, ADT_A03, ADT_A03])
+
     def test_page_with_valid_mrn(self):
             mrn = b"1234"
             r = urllib.request.urlopen(f"http://localhost:{TEST_PAGER_PORT}/page", data=mrn)
@@ -146,5 +163,60 @@ class SimulatorTest(unittest.TestCase):
                 self.simulator.kill()
             shutil.rmtree(self.directory)
 
+class MllpParsingTest(unittest.TestCase):
+
+    def test_frames_split_across_buffers(self):
+        stream = to_mllp(ADT_A01) + to_mllp(ORU_R01) + to_mllp(ADT_A03)
+        messages = []
+        buffer = b""
+        for i in range(0, len(stream), 7):
+            buffer += stream[i:i+7]
+            received, buffer = simulator.parse_mllp_messages(buffer, "test")
+            messages += received
+        self.assertEqual(buffer, b"")
+        self.assertEqual(messages, [to_mllp(m)[1:-2] for m in (ADT_A01, ORU_R01, ADT_A03)]) # without the framing
+
+    def test_trailing_partial_data(self):
+        partial = to_mllp(ADT_A03)
+        for cut in (1, len(partial) // 2, len(partial) - 1): # up to and including the 0x1c
+            buffer = to_mllp(ADT_A01) + to_mllp(ORU_R01) + partial[:cut]
+            messages, remaining = simulator.parse_mllp_messages(buffer, "test")
+            self.assertEqual(len(messages), 2)
+            self.assertEqual(remaining, partial[:cut])
+
+    def test_missing_carriage_return(self):
+        buffer = to_mllp(ADT_A01)[:-1] + b"\x0b"
+        with self.assertRaisesRegex(Exception, "bad MLLP encoding"):
+            simulator.find_mllp_frames(buffer, "test")
+
+    def test_bad_start_byte(self):
+        with self.assertRaisesRegex(Exception, "bad MLLP encoding"):
+            simulator.find_mllp_frames(b"MSH" + to_mllp(ADT_A01), "test")
+        with self.assertRaisesRegex(Exception, "bad MLLP encoding"):
+            simulator.find_mllp_frames(to_mllp(ADT_A01) + b"MSH", "test")
+
+    def test_read_framed_messages(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "messages.mllp")
+            with open(filename, "wb") as w:
+                for m in (ADT_A01, ORU_R01, ADT_A03):
+                    w.write(to_mllp(m))
+            messages = simulator.read_framed_messages(filename)
+            self.assertEqual([bytes(m) for m in messages], [to_mllp(m) for m in (ADT_A01, ORU_R01, ADT_A03)])
+
+    def test_read_framed_messages_empty_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "messages.mllp")
+            open(filename, "wb").close()
+            self.assertEqual(simulator.read_framed_messages(filename), [])
+
+    def test_read_framed_messages_trailing_garbage(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "messages.mllp")
+            with open(filename, "wb") as w:
+                w.write(to_mllp(ADT_A01) + to_mllp(ORU_R01)[:-3])
+            with self.assertRaisesRegex(Exception, "Unexpected data at end of file"):
+                simulator.read_framed_messages(filename)
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+Versioned binary snapshots of the patient database.
+
+A snapshot is an uncompressed .npz file with a schema version, an index of
+MRNs, the patients' sex and age, and all creatinine results packed into a
+single float64 array (patient i owns results[offsets[i]:offsets[i+1]]) with
+the dates the samples were taken alongside them in a float64 array.
+This is much smaller and faster to read and write than pickling the nested
+dicts, and unlike pickle it can be evolved by bumping SCHEMA_VERSION and
+migrating older layouts in load_snapshot.
+
+Schema versions:
+    1 - results without dates
+    2 - dates (seconds since the epoch) of every result
+    3 - results stored as float64, versions 1 and 2 stored them as float32
+        so results loaded from them are rounded to about 7 significant
+        digits (70.69681868961705 comes back as 70.69681549072266)
+
+A running system saves a snapshot with PeriodicSnapshots before every
+message is ACKed, so nothing the hospital won't resend is lost. With
+`--snapshot_interval` it instead takes one at most every interval seconds,
+packed by the thread that owns the database and written in the
+background, which is faster but loses the updates since the last
+snapshot on a crash.
+
+Run as a script to migrate a database.pkl or to benchmark snapshots:
+
+    ./snapshot.py migrate database.pkl database.npz
+    ./snapshot.py benchmark --patients 10000 100000 1000000
+
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import gc
+from array import array
+import itertools
+import os
+import pickle
+import random
+from time import perf_counter
+import numpy as np
+
+SCHEMA_VERSION = 3
+SEX_UNKNOWN = -1 # patient has results but no PAS admission yet
+SEXES = {'F': 0, 'M': 1}
+
+
+def save_snapshot(database: dict, file_path: str, dedup_keys: np.ndarray = None) -> None:
+    """
+    Writes the database to a snapshot. The snapshot is written to a
+    temporary file first and moved into place, so a crash while writing
+    never leaves a corrupt snapshot behind.
+
+    Args:
+        database {dict} - database to save
+        file_path {str} - path of the .npz snapshot
+        dedup_keys {np.ndarray} - optional keys of processed messages, see dedup.py
+    """
+    write_snapshot(pack_snapshot(database, dedup_keys), file_path)
+
+def pack_snapshot(database: dict, dedup_keys: np.ndarray = None) -> dict:
+    """
+    Copies the database into the arrays of a snapshot. Once packed, the
+    snapshot no longer refers to the database, so it can be written by
+    another thread while the database keeps changing.
+
+    Args:
+        database {dict} - database to save
+        dedup_keys {np.ndarray} - optional keys of processed messages, see dedup.py
+
+    Returns:
+        {dict} - arrays to pass to write_snapshot
+    """
+    patients = database.values()
+    n = len(database)
+    lengths = np.fromiter((len(p["results"]) for p in patients), dtype=np.int64, count=n)
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    results = np.fromiter(itertools.chain.from_iterable(p["results"] for p in patients),
+                          dtype=np.float64, count=int(offsets[-1]))
+    dates = np.fromiter(itertools.chain.from_iterable(p["dates"] for p in patients),
+                        dtype=np.float64, count=int(offsets[-1]))
+    sexes = np.fromiter((SEXES.get(p.get("sex"), SEX_UNKNOWN) for p in patients), dtype=np.int8, count=n)
+    ages = np.fromiter((p.get("age", -1) for p in patients), dtype=np.int16, count=n)
+
+    arrays = {"dedup": np.array(dedup_keys, dtype=np.uint64)} if dedup_keys is not None else {}
+    return dict(version=np.array([SCHEMA_VERSION]),
+                mrns=np.array([str(mrn) for mrn in database], dtype=np.str_),
+                sexes=sexes, ages=ages, offsets=offsets, results=results, dates=dates, **arrays)
+
+def write_snapshot(arrays: dict, file_path: str) -> None:
+    """
+    Writes packed arrays to a snapshot, see save_snapshot. The file is
+    synced to disk before it replaces the previous snapshot, so a power
+    or node failure leaves either the old or the new snapshot.
+
+    Args:
+        arrays {dict} - arrays from pack_snapshot
+        file_path {str} - path of the .npz snapshot
+    """
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+def load_snapshot(file_path: str) -> dict:
+    """
+    Reads a snapshot back into the database format used by model.py.
+
+    Args:
+        file_path {str} - path of the .npz snapshot
+
+    Returns:
+        {dict} - database
+    """
+    with np.load(file_path, allow_pickle=False) as data:
+        version = int(data["version"][0])
+        if version > SCHEMA_VERSION:
+            raise ValueError(f"{file_path}: snapshot version {version} is newer than supported version {SCHEMA_VERSION}")
+        mrns = data["mrns"].tolist()
+        sexes = data["sexes"].tolist()
+        ages = data["ages"].tolist()
+        offsets = data["offsets"].tolist()
+        results = memoryview(np.ascontiguousarray(data["results"], dtype=np.float64)).cast("B") # float32 before version 3
+        if version >= 2:
+            dates = memoryview(np.ascontiguousarray(data["dates"], dtype=np.float64)).cast("B")
+        else: # dates unknown, treat the results as taken long ago
+            dates = memoryview(np.zeros(offsets[-1], dtype=np.float64)).cast("B")
+
+    # building millions of small dicts and arrays triggers repeated garbage
+    # collections over all of them, none of which can be part of a cycle
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        database = {}
+        for i, mrn in enumerate(mrns):
+            start, end = offsets[i] * 8, offsets[i+1] * 8 # float64 byte offsets
+            patient = {"dates": array('d'), "results": array('d')}
+            patient["dates"].frombytes(dates[start:end])
+            patient["results"].frombytes(results[start:end])
+            if sexes[i] != SEX_UNKNOWN:
+                patient["sex"] = 'M' if sexes[i] == SEXES['M'] else 'F'
+                patient["age"] = ages[i]
+            database[mrn] = patient
+    finally:
+        if gc_enabled:
+            gc.enable()
+    return database
+
+def migrate_legacy_database(database: dict) -> dict:
+    """
+    Converts a database from before results had dates (a pickled
+    database.pkl) to the current layout, in place.
+
+    Args:
+        database {dict} - legacy database with lists of results
+
+    Returns:
+        {dict} - database with date and result arrays
+    """
+    for patient in database.values():
+        if "dates" not in patient:
+            patient["results"] = array('d', patient["results"])
+            patient["dates"] = array('d', bytes(8 * len(patient["results"]))) # taken long ago
+    return database
+
+def load_dedup_keys(file_path: str) -> np.ndarray:
+    """
+    Reads the keys of processed messages saved with a snapshot.
+
+    Args:
+        file_path {str} - path of the .npz snapshot
+
+    Returns:
+        {np.ndarray} - uint64 keys, empty if there is no snapshot or it has none
+    """
+    if not os.path.exists(file_path):
+        return np.zeros(0, dtype=np.uint64)
+    with np.load(file_path, allow_pickle=False) as data:
+        if "dedup" not in data.files:
+            return np.zeros(0, dtype=np.uint64)
+        return data["dedup"]
+
+def load_state(snapshot_path: str, legacy_path: str) -> dict:
+    """
+    Loads the database from a snapshot, migrating a pickled database
+    (from before snapshots existed) if there is no snapshot yet.
+
+    Args:
+        snapshot_path {str} - path of the .npz snapshot
+        legacy_path {str} - path of the pickled database
+
+    Returns:
+        {dict} - database, or None if neither file exists
+    """
+    if os.path.exists(snapshot_path):
+        return load_snapshot(snapshot_path)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "rb") as pkl:
+            database = migrate_legacy_database(pickle.load(pkl))
+        save_snapshot(database, snapshot_path)
+        return database
+    return None
+
+
+class PeriodicSnapshots:
+    """
+    Takes snapshots of a changing database. By default (interval None)
+    maybe_save writes a snapshot of every change before returning. With an
+    interval a snapshot is taken at most every `interval` seconds and
+    written in the background, changes in between are coalesced into the
+    next snapshot, so updates made since the last one are lost on a crash.
+
+    Every method must be called by the thread that owns the database: the
+    snapshot is packed there and only the packed arrays are handed to a
+    background thread to be written, one snapshot at a time.
+
+    Args:
+        pack {callable} - returns the arrays of a snapshot (see pack_snapshot)
+        write {callable} - writes packed arrays (see write_snapshot)
+        interval {float} - minimum seconds between two snapshots, None to write every change before returning
+    """
+
+    def __init__(self, pack, write, interval: float = None) -> None:
+        self.pack = pack
+        self.write = write
+        self.interval = interval
+        self.saved = 0 # number of snapshots taken
+        self._dirty = False
+        self._last = perf_counter()
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="snapshots")
+        self._pending = None # write in progress
+
+    def mark_dirty(self) -> None:
+        self._dirty = True
+
+    def maybe_save(self) -> None:
+        """
+        Takes a snapshot if there are changes, the interval has passed and
+        the previous snapshot has been written. Without an interval the
+        changes are written before returning.
+        """
+        if self.interval is None:
+            self.save()
+            self.wait()
+            return
+        if not self._dirty or perf_counter() - self._last < self.interval:
+            return
+        if self._pending is not None and not self._pending.done():
+            return # try again on the next call rather than waiting for the disk
+        self.save()
+
+    def save(self) -> None:
+        """
+        Takes a snapshot now if there are changes.
+        """
+        if not self._dirty:
+            return
+        self.wait() # snapshots are written in order
+        self._dirty = False
+        self._last = perf_counter()
+        self.saved += 1
+        self._pending = self._writer.submit(self.write, self.pack())
+
+    def wait(self) -> None:
+        """
+        Waits for the snapshot being written, if any.
+        """
+        if self._pending is None:
+            return
+        try:
+            self._pending.result()
+        except OSError as e: # keep running, the next snapshot retries
+            print(f"Error writing snapshot! {e}")
+        self._pending = None
+
+    def close(self) -> None:
+        """
+        Writes the remaining changes and stops the background thread.
+        """
+        self.save()
+        self.wait()
+        self._writer.shutdown()
+
+
+def _random_database(n_patients: int) -> dict:
+    """
+    Builds a database shaped like the hospital history: up to 20 results
+    per patient, admitted patients have a sex and age.
+    """
+    rng = random.Random(0)
+    database = {}
+    for mrn in range(n_patients):
+        n_results = rng.randint(0, 20)
+        patient = {"dates": array('d', sorted(rng.uniform(1.6e9, 1.7e9) for _ in range(n_results))),
+                   "results": array('d', [rng.uniform(40, 200) for _ in range(n_results)])}
+        if rng.random() < 0.5:
+            patient["sex"] = rng.choice("MF")
+            patient["age"] = rng.randint(0, 100)
+        database[str(mrn)] = patient
+    return database
+
+def benchmark(n_patients: int, directory: str) -> None:
+    """
+    Prints write/read times and file sizes of snapshots and pickles.
+    """
+    database = _random_database(n_patients)
+    npz_path = os.path.join(directory, "benchmark.npz")
+    pkl_path = os.path.join(directory, "benchmark.pkl")
+
+    st = perf_counter()
+    save_snapshot(database, npz_path)
+    npz_write = perf_counter() - st
+    st = perf_counter()
+    load_snapshot(npz_path)
+    npz_read = perf_counter() - st
+
+    st = perf_counter()
+    with open(pkl_path, "wb") as pkl:
+        pickle.dump(database, pkl)
+    pkl_write = perf_counter() - st
+    st = perf_counter()
+    with open(pkl_path, "rb") as pkl:
+        pickle.load(pkl)
+    pkl_read = perf_counter() - st
+
+    print(f"{n_patients} patients:")
+    print(f"  snapshot: write {npz_write:.3f}s read {npz_read:.3f}s size {os.path.getsize(npz_path) / 1e6:.1f} MB")
+    print(f"  pickle:   write {pkl_write:.3f}s read {pkl_read:.3f}s size {os.path.getsize(pkl_path) / 1e6:.1f} MB")
+    os.remove(npz_path)
+    os.remove(pkl_path)
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate", help="Convert a pickled database to a snapshot")
+    migrate.add_argument("pickle", help="database.pkl to read")
+    migrate.add_argument("snapshot", help="database.npz to write")
+    bench = commands.add_parser("benchmark", help="Time snapshot writes and reads against pickle")
+    bench.add_argument("--patients", type=int, nargs="+", default=[10000, 100000, 1000000])
+    bench.add_argument("--directory", default=".", help="Where to write the benchmark files")
+    flags = parser.parse_args()
+
+    if flags.command == "migrate":
+        with open(flags.pickle, "rb") as pkl:
+            save_snapshot(migrate_legacy_database(pickle.load(pkl)), flags.snapshot)
+    else:
+        for n_patients in flags.patients:
+            benchmark(n_patients, flags.directory)
+
+if __name__ == "__main__":
+    main()
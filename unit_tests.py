@@ -4,8 +4,28 @@ are working as intended.
 
 """
 
-from model import from_mllp, to_mllp, pas_process, lims_process
+from model import from_mllp, to_mllp, pas_process, lims_process, hl7_to_epoch, add_result, min_in_window, median_in_window, DAY_SECONDS, send_message, ACK, REJECT_ACK, build_pipeline, stop_pipeline, sigterm_handler, ShutdownRequested, _wait_for_hospital
+from workers import WorkerPool
+from pipeline import BoundedQueue, Stage, STOP, BLOCK, PRIORITIZE_LIMS, DEFER_PERSISTENCE, REJECT
+from snapshot import save_snapshot, load_snapshot, load_state, load_dedup_keys, PeriodicSnapshots
+from dedup import DedupIndex
+from connection import Backoff, ConnectionManager
+from evaluation import alerts_to_frame, evaluate
+from async_runtime import AsyncPager, SnapshotWriter, read_mllp_message
+from concurrent.futures import ThreadPoolExecutor
+from prometheus_client import REGISTRY, Counter
+import metrics
+import asyncio
+from array import array
 import numpy as np
+import pandas as pd
+import os
+import pickle
+import signal
+import socket
+import tempfile
+import threading
+from time import perf_counter, sleep
 
 def test_from_mllp() -> bool:
     """
@@ -80,7 +100,8 @@ def test_pas_process() -> bool:
     pas_process(497030, msg, db)
     
 
-    assert db == {497030: {"results": [],
+    assert db == {497030: {"dates": array('d'),
+                 "results": array('d'),
                  "sex": 'M',
                  "age": 36}}
     
@@ -89,7 +110,8 @@ def test_pas_process() -> bool:
     
     pas_process(497030, msg, db)
 
-    assert db == {497030: {"results": [],
+    assert db == {497030: {"dates": array('d'),
+                 "results": array('d'),
                  "sex": 'F',
                  "age": 36}}
     
@@ -98,10 +120,12 @@ def test_pas_process() -> bool:
 
     pas_process(160116, msg, db)
 
-    assert db == {  497030:  {"results": [],
+    assert db == {  497030:  {"dates": array('d'),
+                            "results": array('d'),
                             "sex": 'F',
                             "age": 36}, 
-                    160116 : {"results": [],
+                    160116 : {"dates": array('d'),
+                            "results": array('d'),
                             "sex": 'M',
                             "age": 22}
                     }
@@ -109,11 +133,13 @@ def test_lims_process():
     """
     Tests LIMS messages are correctly added to the DB
     """
-    db =    {497030:  {  "results": [],
+    db =    {497030:  {  "dates": array('d'),
+                        "results": array('d'),
                         "sex": 'F',
                         "age": 36
                         }, 
-            160116 : {  "results": [],
+            160116 : {  "dates": array('d'),
+                        "results": array('d'),
                         "sex": 'M',
                         "age": 22
                         }}
@@ -125,21 +151,641 @@ def test_lims_process():
     
     tp = lims_process(497030, result, db)
 
-    assert db == {497030:  {"results": [70.69681868961705],
+    assert db == {497030:  {"dates": array('d', [hl7_to_epoch("20240404171700")]),
+                            "results": array('d', [70.69681868961705]),
                             "sex": 'F',
                             "age": 36}, 
-                  160116 : {"results": [],
+                  160116 : {"dates": array('d'),
+                            "results": array('d'),
                             "sex": 'M',
                             "age": 22}}
     
     np.testing.assert_array_equal(tp, np.array([36., 0., 70.69681868961705, 70.69681868961705, 70.69681868961705, 70.69681868961705, 70.69681868961705]).reshape(1,-1))
     
+def test_time_windows():
+    """
+    Tests results are kept in date order and baseline windows only see recent results
+    """
+    now = hl7_to_epoch("20240401084800")
+    assert now == pd.Timestamp("2024-04-01 08:48:00").timestamp()
+
+    patient = {"dates": array('d'), "results": array('d')}
+    add_result(patient, now - 400 * DAY_SECONDS, 50.0)
+    add_result(patient, now - 1 * DAY_SECONDS, 90.0)
+    add_result(patient, now - 30 * DAY_SECONDS, 70.0)
+    add_result(patient, now - 6 * DAY_SECONDS, 85.0)  # arrives late
+    add_result(patient, now, 120.0)
+
+    assert list(patient["results"]) == [50.0, 70.0, 85.0, 90.0, 120.0]
+    assert list(patient["dates"]) == sorted(patient["dates"])
+    assert min_in_window(patient, now, 7) == 85.0
+    assert median_in_window(patient, now, 365) == 87.5
+    assert min_in_window(patient, now - 500 * DAY_SECONDS, 7) is None
+
+class _ThresholdModel:
+    """
+    Stand-in for the RandomForest, predicts an AKI for results over 150.
+    """
+    def predict(self, test_point):
+        return [int(test_point[0, -1] > 150)]
+
+class _MatchModel:
+    """
+    Stand-in for the RandomForest, predicts an AKI for one test point only.
+    """
+    def __init__(self, expected):
+        self.expected = expected
+
+    def predict(self, test_point):
+        return [int(np.array_equal(test_point, self.expected))]
+
+def test_worker_pool():
+    """
+    Tests workers report positive results, all of them by the time stop
+    returns even if there are thousands
+    """
+    positives = []
+    pool = WorkerPool(2, _ThresholdModel(), lambda mrn, timestamp, checkpoints: positives.append(mrn))
+    pool.start()
+    try:
+        for mrn in range(9000):
+            test_point = np.array([40., 1., 90.0, 90.0, 90.0, 90.0, 200.0 if mrn % 3 == 0 else 80.0]).reshape(1,-1)
+            pool.submit(mrn, test_point, "20240401084800", {"received": 0.0})
+    finally:
+        pool.stop()
+
+    assert sorted(positives) == list(range(0, 9000, 3))
+
+def test_worker_pool_late_result():
+    """
+    Tests workers score the test point lims_process built, with a result
+    that arrives late in its place by date, even if the next result of the
+    patient is processed before the worker gets to it
+    """
+    db = {"160116": {"dates": array('d'), "results": array('d'), "sex": 'M', "age": 22}}
+    for day, value in [(1, 60.1), (2, 62.5), (3, 70.0), (5, 65.3), (6, 64.8), (7, 66.9)]:
+        add_result(db["160116"], hl7_to_epoch(f"202404{day:02d}084800"), value)
+    late = ["MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240408084800||ORU^R01|||2.5",
+            "PID|1||160116",
+            "OBR|1||||||20240404084800", # sample taken before the last three
+            "OBX|1|SN|CREATININE||150.0"]
+    expected = np.array([22., 1., 70.0, 150.0, 65.3, 64.8, 66.9]).reshape(1,-1)
+    positives = []
+    pool = WorkerPool(1, _MatchModel(expected), lambda mrn, timestamp, checkpoints: positives.append(timestamp))
+    pool.start()
+    try:
+        pool.submit("160116", lims_process("160116", late, db), "20240408084800", {"received": 0.0})
+        following = [late[0].replace("20240408", "20240409"), late[1], "OBR|1||||||20240409084800", late[3]]
+        pool.submit("160116", lims_process("160116", following, db), "20240409084800", {"received": 0.0})
+    finally:
+        pool.stop()
+
+    assert positives == ["20240408084800"]
+
+def test_bounded_queue():
+    """
+    Tests queues refuse work when full and stages process items in order
+    """
+    q = BoundedQueue("test", 5)
+    for i in range(5):
+        assert q.put(i, block=False)
+    assert q.overloaded()
+    assert not q.put(5, block=False)
+
+    processed = []
+    stage = Stage("test", q, processed.append)
+    stage.start()
+    q.put(STOP)
+    stage.join()
+
+    assert processed == [0, 1, 2, 3, 4]
+    assert q.empty()
+
+    lanes = BoundedQueue("test_lanes", 2, lanes=2)
+    lanes.put("pas 1", lane=1)
+    lanes.put("lims 1")
+    lanes.put("pas 2", lane=1)
+    assert not lanes.put("pas 3", block=False, lane=1) # every lane has its own size
+    lanes.put("lims 2")
+    assert lanes.overloaded()
+    assert [lanes.get() for _ in range(4)] == ["lims 1", "lims 2", "pas 1", "pas 2"]
+
+    lanes = BoundedQueue("test_lanes", 2, lanes=2, max_deferral=0)
+    lanes.put("pas 1", lane=1)
+    lanes.put("lims 1")
+    assert lanes.get() == "pas 1" # waited too long
+
+def test_pipeline_dedup():
+    """
+    Tests the state stage skips resent LIMS messages and snapshots the dedup index with the database
+    """
+    result = ["MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240404171700||ORU^R01|||2.5",
+              "PID|1||497030",
+              "OBR|1||||||20240404171700",
+              "OBX|1|SN|CREATININE||70.69681868961705"]
+    db = {"497030": {"dates": array('d'), "results": array('d'), "sex": 'F', "age": 36}}
+    dedup = DedupIndex(capacity=10)
+    written = []
+    snapshots = PeriodicSnapshots(lambda: (len(db["497030"]["results"]), len(dedup)), written.append, interval=0)
+
+    submit, stages = build_pipeline(db, _ThresholdModel(), "localhost:1", [], dedup, snapshots)
+    for _ in range(3): # resent after reconnects
+        assert submit(False, "497030", list(result), {"received": 0.0, "parsed": 0.0}) == ACK
+    stop_pipeline(stages)
+    snapshots.close()
+
+    assert list(db["497030"]["results"]) == [70.69681868961705]
+    assert DedupIndex.message_key("497030", result) in dedup
+    assert written[-1] == (1, 1)
+
+def test_pipeline_dedup_failed_message():
+    """
+    Tests a LIMS message that fails to apply is not taken for processed, so it is applied when resent
+    """
+    result = ["MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240404171700||ORU^R01|||2.5",
+              "PID|1||497030",
+              "OBR|1||||||20240404171700",
+              "OBX|1|SN|CREATININE||70.69681868961705"]
+    db = {}
+    dedup = DedupIndex(capacity=10)
+    snapshots = PeriodicSnapshots(lambda: None, lambda arrays: None, interval=0)
+
+    submit, stages = build_pipeline(db, _ThresholdModel(), "localhost:1", [], dedup, snapshots)
+    submit(False, "497030", list(result), {"received": 0.0, "parsed": 0.0}) # not admitted yet
+    stop_pipeline(stages)
+    assert DedupIndex.message_key("497030", result) not in dedup
+
+    db["497030"] = {"dates": array('d'), "results": array('d'), "sex": 'F', "age": 36}
+    submit, stages = build_pipeline(db, _ThresholdModel(), "localhost:1", [], dedup, snapshots)
+    submit(False, "497030", list(result), {"received": 0.0, "parsed": 0.0})
+    stop_pipeline(stages)
+    snapshots.close()
+    assert list(db["497030"]["results"]) == [70.69681868961705]
+    assert DedupIndex.message_key("497030", result) in dedup
+
+def _pas_message(mrn):
+    return ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240102135300||ADT^A01|||2.5",
+            f"PID|1||{mrn}||ROSCOE DOHERTY||19870515|M"]
+
+def _lims_message(mrn, value):
+    return ["MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240404171700||ORU^R01|||2.5",
+            f"PID|1||{mrn}",
+            "OBR|1||||||20240404171700",
+            f"OBX|1|SN|CREATININE||{value}"]
+
+def _pipeline(policy, queue_size=10, start=True):
+    """
+    Pipeline over a small database with snapshots kept in memory.
+    """
+    db = {str(mrn): {"dates": array('d'), "results": array('d'), "sex": 'F', "age": 36} for mrn in range(20)}
+    dedup = DedupIndex(capacity=100)
+    written = []
+    snapshots = PeriodicSnapshots(lambda: sum(len(p["results"]) for p in db.values()), written.append, interval=0)
+    submit, stages = build_pipeline(db, _ThresholdModel(), "localhost:1", [], dedup, snapshots,
+                                    policy=policy, queue_size=queue_size, start=start)
+    return db, dedup, snapshots, written, submit, stages
+
+def _overloads(policy):
+    return REGISTRY.get_sample_value("Overload_counter_total", {"policy": policy}) or 0
+
+def test_pipeline_block():
+    """
+    Tests the block policy applies every message in order
+    """
+    db, dedup, snapshots, written, submit, stages = _pipeline(BLOCK, queue_size=2)
+    acks = [submit(False, "1", _lims_message("1", 60.0 + i), {"received": 0.0}) for i in range(10)]
+    stop_pipeline(stages)
+    snapshots.close()
+
+    assert acks == [ACK] * 10
+    assert list(db["1"]["results"]) == [60.0 + i for i in range(10)]
+    assert written[-1] == 10
+
+def test_pipeline_saves_before_ack():
+    """
+    Tests submit only returns the ACK once the message has been applied and saved
+    """
+    db = {"1": {"dates": array('d'), "results": array('d'), "sex": 'F', "age": 36}}
+    written = []
+    snapshots = PeriodicSnapshots(lambda: len(db["1"]["results"]), written.append)
+    submit, stages = build_pipeline(db, _ThresholdModel(), "localhost:1", [], DedupIndex(capacity=10), snapshots)
+    for i in range(5):
+        assert submit(False, "1", _lims_message("1", 60.0 + i), {"received": 0.0}) == ACK
+        assert written[-1] == i + 1
+    stop_pipeline(stages)
+    snapshots.close()
+
+def test_pipeline_prioritize_lims():
+    """
+    Tests LIMS results go ahead of waiting PAS updates, except results of a patient whose admission is waiting
+    """
+    before = _overloads(PRIORITIZE_LIMS)
+    db, dedup, snapshots, written, submit, stages = _pipeline(PRIORITIZE_LIMS, start=False)
+    submit(True, "1", _pas_message("1"), {})
+    submit(False, "2", _lims_message("2", 80.0), {})
+    submit(False, "1", _lims_message("1", 80.0), {}) # needs the admission first
+    submit(False, "3", _lims_message("3", 80.0), {})
+    submit(True, "4", _pas_message("4"), {})
+
+    state_queue = stages[0].inbox
+    order = [state_queue.get()[:2] for _ in range(5)]
+    assert order == [(False, "2"), (False, "3"), (True, "1"), (False, "1"), (True, "4")]
+    metrics.flush() # counted by the socket thread, flushed once per message in main
+    assert _overloads(PRIORITIZE_LIMS) == before + 2
+
+def test_pipeline_defer_persistence():
+    """
+    Tests snapshots are skipped while the state queue is overloaded and the last changes are still saved
+    """
+    before = _overloads(DEFER_PERSISTENCE)
+    db, dedup, snapshots, written, submit, stages = _pipeline(DEFER_PERSISTENCE, queue_size=10, start=False)
+    for mrn in range(10):
+        submit(False, str(mrn), _lims_message(mrn, 80.0), {"received": 0.0})
+    for stage in stages:
+        stage.start()
+    stop_pipeline(stages)
+    snapshots.close()
+
+    assert _overloads(DEFER_PERSISTENCE) >= before + 2 # first items were taken with 9 and 8 waiting
+    assert snapshots.saved < 10
+    assert written[-1] == 10
+
+def test_pipeline_reject():
+    """
+    Tests a full queue rejects with an MSA|AR ACK and the rejected message is not remembered as processed
+    """
+    db, dedup, snapshots, written, submit, stages = _pipeline(REJECT, queue_size=1, start=False)
+    accepted, rejected = _lims_message("1", 80.0), _lims_message("2", 80.0)
+    assert submit(False, "1", accepted, {"received": 0.0}) == ACK
+    ack = submit(False, "2", rejected, {"received": 0.0})
+    assert ack == REJECT_ACK
+    assert "MSA|AR" in to_mllp(ack).decode()
+
+    for stage in stages:
+        stage.start()
+    stop_pipeline(stages)
+    snapshots.close()
+
+    assert DedupIndex.message_key("1", accepted) in dedup
+    assert DedupIndex.message_key("2", rejected) not in dedup # processed when the hospital resends it
+    assert list(db["2"]["results"]) == []
+
+def test_snapshot():
+    """
+    Tests the database survives a snapshot round trip and pickles are migrated
+    """
+    db = {"497030": {"dates": array('d', [1704067200.0, 1704110400.0]), "results": array('d', [70.69681868961705, 81.25130990327432]), "sex": 'F', "age": 36},
+          "160116": {"dates": array('d'), "results": array('d'), "sex": 'M', "age": 22},
+          "822825": {"dates": array('d', [1704067200.0, 1704326400.0]), "results": array('d', [68.5, 1810597.8421457])}}
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_path = os.path.join(directory, "database.npz")
+        legacy_path = os.path.join(directory, "database.pkl")
+
+        save_snapshot(db, snapshot_path)
+        assert load_snapshot(snapshot_path) == db
+
+        os.remove(snapshot_path)
+        assert load_state(snapshot_path, legacy_path) is None
+
+        legacy = {mrn: dict(patient, results=list(patient["results"])) for mrn, patient in db.items()}
+        for patient in legacy.values():
+            del patient["dates"]
+        with open(legacy_path, "wb") as pkl:
+            pickle.dump(legacy, pkl)
+        migrated = load_state(snapshot_path, legacy_path)
+        assert [list(p["results"]) for p in migrated.values()] == [list(p["results"]) for p in db.values()]
+        assert all(set(p["dates"]) <= {0.0} for p in migrated.values())
+        assert load_snapshot(snapshot_path) == migrated
+
+def test_backoff():
+    """
+    Tests backoff delays are jittered, capped and reset after success
+    """
+    backoff = Backoff(base=0.1, cap=1.0)
+    delays = [backoff.next_delay() for _ in range(10)]
+    assert all(0 <= d <= min(1.0, 0.1 * 2 ** i) for i, d in enumerate(delays))
+    backoff.reset()
+    assert backoff.next_delay() <= 0.1
+
+def test_connection_manager():
+    """
+    Tests connections give up after the timeout and recover once the server is back
+    """
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server:
+        server.bind(("localhost", 0))
+        address = f"localhost:{server.getsockname()[1]}"
+
+        manager = ConnectionManager("test", address, give_up_after=0.2)
+        assert manager.connect() is None # nothing listening yet
+        assert not manager.healthy and manager.failures > 0
+
+        server.listen(1)
+        manager.give_up_after = 5
+        with manager.connect() as s:
+            assert manager.healthy and manager.failures == 0
+        manager.closed(clean=True)
+        assert not manager.healthy
+
+class _SilentPager:
+    """
+    Pager that accepts connections but never responds.
+    """
+    def __init__(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("localhost", 0))
+        self.server.listen(16)
+        self.port = self.server.getsockname()[1]
+        self.clients = []
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                self.clients.append(self.server.accept()[0])
+            except OSError: # closed
+                return
+
+    def close(self):
+        self.server.close()
+        for client in self.clients:
+            client.close()
+
+def test_send_message_gives_up():
+    """
+    Tests a page is dropped after give_up_after even if the pager accepts connections but never responds
+    """
+    pager = _SilentPager()
+    try:
+        st = perf_counter()
+        send_message("123456", "localhost", pager.port, give_up_after=1, timeout=0.2)
+        assert perf_counter() - st < 2
+    finally:
+        pager.close()
+
+def test_sigterm_handler():
+    """
+    Tests SIGTERM only interrupts main while it is waiting for the hospital
+    """
+    shutdown = {"requested": False, "idle": False}
+    sigterm_handler(signal.SIGTERM, None, shutdown=shutdown) # busy with a message
+    assert shutdown["requested"]
+
+    try:
+        _wait_for_hospital(shutdown, lambda: "message") # requested before waiting
+        assert False, "should not wait once shutdown was requested"
+    except ShutdownRequested:
+        pass
+
+    shutdown["requested"] = False
+    def wait(): # SIGTERM while blocked in recv
+        sigterm_handler(signal.SIGTERM, None, shutdown=shutdown)
+    try:
+        _wait_for_hospital(shutdown, wait)
+        assert False, "should be interrupted"
+    except ShutdownRequested:
+        pass
+    assert not shutdown["idle"]
+
+def test_evaluation():
+    """
+    Tests alerts are matched with expected aki events by mrn and time
+    """
+    checkpoints = {"received": 1.0, "parsed": 1.5, "updated": 2.0, "predicted": 3.0, "paged": 5.0}
+    responses = [("1", "20240101120000", checkpoints),  # detected on time
+                 ("2", "20240103120000", checkpoints),  # detected a day late
+                 ("3", "20240101120000", checkpoints)]  # not an aki
+    expected = pd.DataFrame({"mrn": ["1", "2", "4"],
+                             "date": pd.to_datetime(["2024-01-01 12:00", "2024-01-02 12:00", "2024-01-01 12:00"])})
+
+    alerts = alerts_to_frame(responses)
+    assert list(alerts.loc[0, ["parse", "state", "inference", "paging", "total"]]) == [0.5, 0.5, 1.0, 2.0, 4.0]
+
+    results = evaluate(alerts, expected)
+    assert (results["true_positives"], results["false_negatives"], results["false_positives"]) == (2, 1, 1)
+    assert sorted(results["matched"]["time_to_detect"]) == [pd.Timedelta(0), pd.Timedelta(days=1)]
+    np.testing.assert_almost_equal(results["f3"], 10 * (2/3) * (2/3) / (9 * (2/3) + (2/3)))
+
+    results = evaluate(alerts_to_frame([]), expected) # nothing paged
+    assert (results["true_positives"], results["false_negatives"], results["false_positives"]) == (0, 3, 0)
+
+def test_dedup_index():
+    """
+    Tests resent LIMS messages are recognised and the index stays bounded
+    """
+    result = ["MSH|^~\&|SIMULATION|SOUTH RIVERSIDE|||20240404171700||ORU^R01|||2.5",
+              "PID|1||497030",
+              "OBR|1||||||20240404171700",
+              "OBX|1|SN|CREATININE||70.69681868961705"]
+    later = result[:3] + ["OBX|1|SN|CREATININE||80.1"]
+
+    dedup = DedupIndex(capacity=2)
+    key = DedupIndex.message_key("497030", result)
+    assert key == DedupIndex.message_key("497030", list(result))
+    assert key != DedupIndex.message_key("497030", later)
+    assert key != DedupIndex.message_key("160116", result)
+
+    dedup.add(key)
+    assert key in dedup
+    dedup.add(key)
+    assert len(dedup) == 1
+
+    dedup.add(DedupIndex.message_key("497030", later))
+    dedup.add(DedupIndex.message_key("160116", result))
+    assert key not in dedup # oldest key evicted
+    assert len(dedup) == 2
+
+    with tempfile.TemporaryDirectory() as directory:
+        snapshot_path = os.path.join(directory, "database.npz")
+        assert len(load_dedup_keys(snapshot_path)) == 0
+        save_snapshot({}, snapshot_path, dedup.to_array())
+        restored = DedupIndex(capacity=2, keys=load_dedup_keys(snapshot_path))
+    np.testing.assert_array_equal(restored.to_array(), dedup.to_array())
+    assert DedupIndex.message_key("160116", result) in restored
+
+    try:
+        DedupIndex(capacity=0)
+        assert False, "an index that can't hold a key would drop every LIMS message"
+    except ValueError:
+        pass
+
+def test_read_mllp_message():
+    """
+    Tests framed messages are read one at a time from an asyncio stream
+    """
+    async def read_all():
+        reader = asyncio.StreamReader()
+        framed = to_mllp(["MSH|1"]) + to_mllp(["MSH|2", "PID|3"])
+        reader.feed_data(framed[:5]) # messages split across reads
+        reader.feed_data(framed[5:])
+        reader.feed_eof()
+        return [await read_mllp_message(reader) for _ in range(3)]
+
+    first, second, closed = asyncio.run(read_all())
+    assert from_mllp(first) == ["MSH|1"]
+    assert from_mllp(second) == ["MSH|2", "PID|3"]
+    assert closed == b""
+
+def test_async_pager():
+    """
+    Tests pages are sent concurrently and report the pager's HTTP status
+    """
+    paged = []
+
+    async def handle(reader, writer):
+        await reader.readuntil(b"\r\n\r\n")
+        paged.append((await reader.read(6)).decode())
+        writer.write(b"HTTP/1.0 200 OK\r\n\r\n")
+        await writer.drain()
+        writer.close()
+
+    async def page_all():
+        server = await asyncio.start_server(handle, "localhost", 0)
+        pager = AsyncPager(f"localhost:{server.sockets[0].getsockname()[1]}", give_up_after=1, timeout=1)
+        async with server:
+            return await asyncio.gather(pager.page("123456"), pager.page("654321"))
+
+    assert asyncio.run(page_all()) == [200, 200]
+    assert sorted(paged) == ["123456", "654321"]
+
+def test_async_pager_gives_up():
+    """
+    Tests an async page is dropped after give_up_after even if the pager accepts connections but never responds
+    """
+    pager = _SilentPager()
+    try:
+        st = perf_counter()
+        status = asyncio.run(AsyncPager(f"localhost:{pager.port}", give_up_after=1, timeout=0.2).page("123456"))
+        assert status is None
+        assert perf_counter() - st < 2
+    finally:
+        pager.close()
+
+def test_snapshot_writer():
+    """
+    Tests changes made while a snapshot is being written are coalesced into the next one
+    """
+    written = []
+
+    async def burst():
+        with ThreadPoolExecutor(1) as executor:
+            snapshots = SnapshotWriter(lambda: len(written), written.append, executor)
+            for _ in range(10):
+                snapshots.mark_dirty()
+            await asyncio.sleep(0) # first snapshot starts
+            for _ in range(10):
+                snapshots.mark_dirty()
+            await snapshots.flush()
+
+    asyncio.run(burst())
+    assert written == [0, 1]
+
+def test_snapshot_writer_cancelled_flush():
+    """
+    Tests cancelling a task waiting for a snapshot (SIGTERM while ACKing) doesn't cancel the snapshot
+    """
+    written = []
+
+    async def shutdown():
+        with ThreadPoolExecutor(1) as executor:
+            snapshots = SnapshotWriter(lambda: len(written), lambda n: (sleep(0.05), written.append(n)), executor)
+            snapshots.mark_dirty()
+            waiting = asyncio.create_task(snapshots.flush())
+            await asyncio.sleep(0.01)
+            waiting.cancel()
+            await snapshots.flush() # the final snapshot on shutdown
+
+    asyncio.run(shutdown())
+    assert written == [0]
+
+def test_periodic_snapshots():
+    """
+    Tests changes are coalesced into one snapshot per interval and the last ones are written on close
+    """
+    database = {"count": 0}
+    written = []
+    snapshots = PeriodicSnapshots(lambda: dict(database), written.append, interval=60)
+    for _ in range(100):
+        database["count"] += 1
+        snapshots.mark_dirty()
+        snapshots.maybe_save()
+    assert snapshots.saved == 0 # interval hasn't passed
+
+    snapshots.interval = 0
+    snapshots.maybe_save()
+    snapshots.wait()
+    assert written == [{"count": 100}]
+    snapshots.maybe_save()
+    assert snapshots.saved == 1 # nothing changed
+
+    database["count"] += 1
+    snapshots.mark_dirty()
+    snapshots.close()
+    assert written == [{"count": 100}, {"count": 101}]
+
+    written = []
+    snapshots = PeriodicSnapshots(lambda: dict(database), written.append) # default, before every ACK
+    for _ in range(3):
+        database["count"] += 1
+        snapshots.mark_dirty()
+        snapshots.maybe_save()
+        assert written[-1] == database # on disk when maybe_save returns
+    snapshots.close()
+    assert len(written) == 3
+
+def test_metrics():
+    """
+    Tests counter updates are batched until flushed, alert latencies are
+    observed per stage and blood buckets follow the data
+    """
+    counter = Counter("Test_batched_counter", 'test')
+    metrics.inc(counter)
+    metrics.inc(counter, 2)
+    assert REGISTRY.get_sample_value("Test_batched_counter_total") == 0
+    metrics.flush()
+    assert REGISTRY.get_sample_value("Test_batched_counter_total") == 3
+    metrics.flush()
+    assert REGISTRY.get_sample_value("Test_batched_counter_total") == 3
+
+    before = REGISTRY.get_sample_value("Stage_latency_count", {"stage": "inference"}) or 0
+    metrics.observe_latencies({"received": 1.0, "parsed": 1.5, "updated": 2.0, "predicted": 3.0, "paged": 5.0})
+    assert REGISTRY.get_sample_value("Stage_latency_count", {"stage": "inference"}) == before + 1
+    assert REGISTRY.get_sample_value("Stage_latency_bucket", {"stage": "total", "le": "3.0"}) == 0
+
+    buckets = metrics.select_buckets(list(range(1, 101)), n_buckets=4)
+    assert buckets == [25.8, 50.5, 75.2, float("inf")]
+    assert metrics.select_buckets([100.0] * 10) == [100.0, float("inf")] # identical quantiles merged
 
 def run_tests():
     test_to_mllp()
     test_from_mllp()
     test_pas_process()
     test_lims_process()
+    test_time_windows()
+    test_worker_pool()
+    test_worker_pool_late_result()
+    test_bounded_queue()
+    test_pipeline_dedup()
+    test_pipeline_dedup_failed_message()
+    test_pipeline_block()
+    test_pipeline_saves_before_ack()
+    test_pipeline_prioritize_lims()
+    test_pipeline_defer_persistence()
+    test_pipeline_reject()
+    test_snapshot()
+    test_backoff()
+    test_connection_manager()
+    test_send_message_gives_up()
+    test_sigterm_handler()
+    test_evaluation()
+    test_dedup_index()
+    test_read_mllp_message()
+    test_async_pager()
+    test_async_pager_gives_up()
+    test_snapshot_writer()
+    test_snapshot_writer_cancelled_flush()
+    test_periodic_snapshots()
+    test_metrics()
     print("All tests passed!")
 
 
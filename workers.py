@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Multi-process inference for the AKI detection system.
+
+The ingestion process (model.main) keeps reading from the hospital socket,
+updates the patient database and builds the test point of every LIMS
+result as in single process mode, then shards the scoring to N worker
+processes by mrn, so the alerts of a given patient are paged in arrival
+order. The test point is passed to the worker with the task rather than
+through shared memory: a window shared per patient could be overwritten
+by the next result of the patient before the worker reads it. The trained
+model is loaded once in the parent and shared copy-on-write with the
+forked workers.
+
+Workers only score: positive results are sent back to the parent, which
+pages them, so paging metrics land in the registry Prometheus scrapes.
+
+Run as a script to measure how throughput scales with the number of
+workers (0 scores in the ingestion process):
+
+    ./workers.py benchmark --workers 0 1 2 4
+
+
+"""
+
+import argparse
+import multiprocessing
+import pickle
+import queue
+import random
+import threading
+from time import perf_counter
+import numpy as np
+
+WINDOW = 5 # number of recent results used as features
+
+
+def _worker_loop(tasks, results, trained_model) -> None:
+    """
+    Runs inference for the LIMS results sharded to this worker, in the
+    order they were received. Positive results are put on the results
+    queue followed by None once the worker is told to stop.
+    """
+    while True:
+        task = tasks.get()
+        if task is None: # shutdown
+            results.put(None)
+            break
+        mrn, test_point, timestamp, checkpoints = task
+        try:
+            prediction = trained_model.predict(test_point)[0]
+            checkpoints["predicted"] = perf_counter()
+            if prediction == 1:
+                results.put((mrn, timestamp, checkpoints))
+        except Exception as e:
+            print(f"worker: error scoring a result of {mrn}: {e}")
+
+
+class WorkerPool:
+    """
+    Pool of forked inference workers.
+
+    A collector thread in the parent reads the positive results of the
+    workers as they come and hands them to on_positive, so the results
+    queue never fills up and a worker can always exit.
+
+    Args:
+        n_workers {int} - number of worker processes
+        trained_model - model with a sklearn style predict method
+        on_positive {callable} - called in the parent with (mrn, HL7 timestamp, checkpoints) when an AKI is detected
+    """
+
+    def __init__(self, n_workers: int, trained_model, on_positive) -> None:
+        ctx = multiprocessing.get_context("fork") # share the model copy-on-write
+        self.on_positive = on_positive
+        self.tasks = [ctx.SimpleQueue() for _ in range(n_workers)]
+        self.results = ctx.Queue()
+        self.processes = [
+            ctx.Process(target=_worker_loop, args=(tasks, self.results, trained_model), daemon=True)
+            for tasks in self.tasks
+        ]
+        self._collector = threading.Thread(target=self._collect, name="collector", daemon=True)
+
+    def start(self) -> None:
+        for p in self.processes:
+            p.start()
+        self._collector.start() # after forking, so the workers don't inherit the thread
+
+    def _collect(self) -> None:
+        running = len(self.processes)
+        while running > 0:
+            try:
+                result = self.results.get(timeout=1)
+            except queue.Empty:
+                if not any(p.is_alive() for p in self.processes): # killed without saying so
+                    return
+                continue
+            if result is None: # a worker has stopped
+                running -= 1
+                continue
+            try:
+                self.on_positive(*result)
+            except Exception as e:
+                print(f"collector: error handling a positive result: {e}")
+
+    def submit(self, mrn: str, test_point: np.array, timestamp: str, checkpoints: dict) -> None:
+        """
+        Queues a LIMS result for inference.
+
+        Args:
+            mrn {str} - patient mrn
+            test_point {np.array} - (1, 7) test point built by model.lims_process
+            timestamp {str} - HL7 timestamp of the message
+            checkpoints {dict} - perf_counter() times the message passed each stage so far
+        """
+        self.tasks[hash(mrn) % len(self.tasks)].put((mrn, test_point, timestamp, checkpoints))
+
+    def stop(self) -> None:
+        """
+        Stops the workers once they have processed every task submitted,
+        returning after on_positive was called for all their results.
+        """
+        for tasks in self.tasks:
+            tasks.put(None)
+        self._collector.join() # drains the results, workers can't exit with results unread
+        for p in self.processes:
+            p.join()
+
+
+def _test_point(age: int, sex: str, recent: list) -> np.array:
+    """
+    Same feature vector as model.lims_process: age, sex and the 5 most
+    recent results, padded with their mean if there are fewer than 5.
+    """
+    window = [np.mean(recent)] * (WINDOW - len(recent)) + list(recent)
+    return np.array([age, 1 if sex == 'M' else 0] + window).reshape(1, -1)
+
+
+def benchmark(n_workers: int, n_results: int, n_patients: int, trained_model) -> None:
+    """
+    Prints the throughput of scoring LIMS results with n_workers workers,
+    from the first submit until stop returns, and the time the ingestion
+    process spends per result.
+    """
+    rng = random.Random(0)
+    demographics = {str(mrn): (rng.randint(18, 90), rng.choice("MF")) for mrn in range(n_patients)}
+    results = [(str(rng.randrange(n_patients)), rng.uniform(40, 200)) for _ in range(n_results)]
+    history = {} # mrn -> results, in date order as they arrive
+    positives = []
+
+    pool = None
+    if n_workers > 0:
+        pool = WorkerPool(n_workers, trained_model, lambda mrn, timestamp, checkpoints: positives.append(mrn))
+        pool.start()
+    st = perf_counter()
+    for mrn, result in results:
+        recent = history.setdefault(mrn, [])
+        recent.append(result)
+        del recent[:-WINDOW]
+        test_point = _test_point(*demographics[mrn], recent)
+        if pool is not None:
+            pool.submit(mrn, test_point, "20240401084800", {"received": perf_counter()})
+        elif trained_model.predict(test_point)[0] == 1:
+            positives.append(mrn)
+    submitted = perf_counter() - st
+    if pool is not None:
+        pool.stop()
+    elapsed = perf_counter() - st
+    print(f"{n_workers} workers: {n_results / elapsed:.0f} results/s, "
+          f"{submitted / n_results * 1e6:.0f} us per result in the ingestion process, {len(positives)} positives")
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    bench = commands.add_parser("benchmark", help="Time scoring with different numbers of workers")
+    bench.add_argument("--workers", type=int, nargs="+", default=[0, 1, 2, 4])
+    bench.add_argument("--results", type=int, default=2000)
+    bench.add_argument("--patients", type=int, default=1000)
+    bench.add_argument("--model", default="trained_model.pkl")
+    flags = parser.parse_args()
+
+    with open(flags.model, "rb") as file:
+        trained_model = pickle.load(file)
+    for n_workers in flags.workers:
+        benchmark(n_workers, flags.results, flags.patients, trained_model)
+
+if __name__ == "__main__":
+    main()